@@ -67,7 +67,7 @@ u[abs(x) >= 10] = 50
 
 
 n = 60
-eigvals, eigvecs = time_independent.fdlp(x, u, n, boundary="box")
+eigvals, eigvecs = time_independent.cached_fdlp(x, u, n, boundary="box")
 for n in range(eigvecs.shape[1]):
     y = eigvecs[:, n]
     f0 = eigvals[n] + args.delta
@@ -2,8 +2,12 @@
 
 
 import argparse
+import functools
+import itertools
+import os
 import scipy as s
-from wells._solver import ccgnlse
+
+import wells.util as util
 
 
 parser = argparse.ArgumentParser()
@@ -11,17 +15,21 @@ parser.add_argument("--input",
                     help="Read initial condition from a file",
                     type=str)
 parser.add_argument("--delta",
-                    help="Detuning between the pump and the resonance",
+                    help="Detuning between the pump and the resonance, "
+                         "several values make an ensemble",
                     type=float,
-                    default=0.0)
+                    nargs="+",
+                    default=[0.0])
 parser.add_argument("--pump",
-                    help="Pump",
+                    help="Pump, several values make an ensemble",
                     type=float,
-                    default=0.0)
+                    nargs="+",
+                    default=[0.0])
 parser.add_argument("--loss",
-                    help="Linear losses",
+                    help="Linear losses, several values make an ensemble",
                     type=float,
-                    default=0.0)
+                    nargs="+",
+                    default=[0.0])
 parser.add_argument("--mint",
                     help="Start time",
                     type=float,
@@ -38,7 +46,188 @@ parser.add_argument("--dt",
                     help="Internal solver time step",
                     type=float,
                     default=1E-4)
+parser.add_argument("--engine",
+                    help="Split-step engine to use",
+                    choices=["fortran", "python"],
+                    default="fortran")
+parser.add_argument("--method",
+                    help="Integration scheme",
+                    choices=["split-step", "rk4ip"],
+                    default="split-step")
+parser.add_argument("--order",
+                    help="Order of the split-step scheme",
+                    type=int,
+                    choices=[2, 4, 6],
+                    default=2)
+parser.add_argument("--rtol",
+                    help="Relative tolerance, enables adaptive step size",
+                    type=float)
+parser.add_argument("--atol",
+                    help="Absolute tolerance for adaptive step size",
+                    type=float,
+                    default=1E-8)
+parser.add_argument("--rigor",
+                    help="FFTW planner rigor",
+                    choices=["estimate", "measure", "patient", "exhaustive"],
+                    default="estimate")
+parser.add_argument("--threads",
+                    help="Number of threads for FFTs and the nonlinear step",
+                    type=int,
+                    default=1)
+parser.add_argument("--wisdom",
+                    help="FFTW wisdom file to import and update",
+                    type=str)
+parser.add_argument("--minx",
+                    help="Left edge of the recorded window",
+                    type=float)
+parser.add_argument("--maxx",
+                    help="Right edge of the recorded window",
+                    type=float)
+parser.add_argument("--ssx",
+                    help="Record every n-th point in x",
+                    type=int,
+                    default=1)
+parser.add_argument("--sst",
+                    help="Record every n-th snapshot in t",
+                    type=int,
+                    default=1)
+parser.add_argument("--precision",
+                    help="Precision of the computation",
+                    choices=["double", "single"],
+                    default="double")
+parser.add_argument("--storage",
+                    help="Precision of the stored states",
+                    choices=["double", "single"],
+                    default="double")
+parser.add_argument("--stream",
+                    help="Stream snapshots to disk instead of keeping them "
+                         "in memory",
+                    action="store_true")
+parser.add_argument("--schedule",
+                    help="Text file with the columns t, delta, pump and "
+                         "loss to follow during the propagation",
+                    type=str)
+parser.add_argument("--observe",
+                    help="Record the observables instead of the states",
+                    action="store_true")
+parser.add_argument("--probe",
+                    help="Record the field at this coordinate, can be "
+                         "repeated",
+                    type=float,
+                    action="append",
+                    default=[])
+parser.add_argument("--pstep",
+                    help="Also record the field at the probes after every "
+                         "n-th internal step",
+                    type=int,
+                    default=0)
+parser.add_argument("--modes",
+                    help="Number of linear modes to project the field on",
+                    type=int,
+                    default=0)
+parser.add_argument("--steady",
+                    help="Stop once the relative change of the amplitude "
+                         "between snapshots stays below this tolerance",
+                    type=float)
+parser.add_argument("--patience",
+                    help="Number of snapshots the change has to stay below "
+                         "the steady state tolerance",
+                    type=int,
+                    default=8)
 args = parser.parse_args()
+fixed = args.method == "split-step" and args.rtol is None
+if args.stream and not fixed:
+    parser.error("--stream requires the fixed-step split-step method")
+if args.steady is not None and not fixed:
+    parser.error("--steady requires the fixed-step split-step method")
+if args.observe and not fixed:
+    parser.error("--observe requires the fixed-step split-step method")
+if args.observe and (args.stream or args.steady is not None):
+    parser.error("--observe cannot be combined with --stream or --steady")
+if args.schedule is not None and not fixed:
+    parser.error("--schedule requires the fixed-step split-step method")
+if args.pstep and not (args.observe and args.probe):
+    parser.error("--pstep requires --observe and at least one --probe")
+
+
+# Several values of the parameters make an ensemble of independent
+# runs, one for every combination of them, which are integrated
+# together and saved the same way as the separate runs would be.
+members = list(itertools.product(args.delta, args.pump, args.loss))
+ensemble = len(members) > 1
+if ensemble and not fixed:
+    parser.error("an ensemble requires the fixed-step split-step method")
+if ensemble and (args.input is not None or args.stream or
+                 args.steady is not None or args.observe or
+                 args.schedule is not None):
+    parser.error("an ensemble cannot be combined with --input, --stream, "
+                 "--steady, --observe or --schedule")
+if (args.precision == "single" and args.engine == "fortran" and
+        (not fixed or args.observe or ensemble)):
+    parser.error("single precision computation with --engine fortran "
+                 "requires the fixed-step split-step method without "
+                 "--observe or an ensemble")
+
+
+schedule = None
+if args.schedule is not None:
+    # Piecewise-linear tables of the parameters against time.
+    schedule = tuple(s.loadtxt(args.schedule, ndmin=2).T)
+
+
+dtypes = {"double": s.complex128, "single": s.complex64}
+dtype = dtypes[args.precision]
+storage = dtypes[args.storage]
+
+
+if args.engine == "fortran":
+    from wells._solver import ccgnlse, fftw
+    fftw.set_threads(args.threads)
+    fftw.set_rigor(args.rigor)
+    if args.wisdom is not None and os.path.exists(args.wisdom):
+        fftw.import_wisdom(args.wisdom)
+    # The schedules are passed only if given, together with the number
+    # of their points.
+    tables = {}
+    if schedule is not None:
+        tables = dict(zip(("times", "deltas", "pumps", "losses"), schedule))
+        tables["nschedule"] = len(schedule[0])
+    steady = {}
+    if args.steady is not None:
+        steady = {"tol": args.steady, "patience": args.patience}
+    integrate = functools.partial(
+        ccgnlse.integrate, order=args.order, **tables, **steady)
+    integrate_adaptive = ccgnlse.integrate_adaptive
+    integrate_stream = functools.partial(
+        ccgnlse.integrate_stream, order=args.order, **tables, **steady)
+    integrate_ensemble = functools.partial(
+        ccgnlse.ensemble, order=args.order)
+    if args.method == "rk4ip":
+        integrate = ccgnlse.integrate_rk4ip
+    if args.precision == "single":
+        integrate = functools.partial(
+            ccgnlse.integrate_single, order=args.order, **tables,
+            **steady)
+        integrate_stream = functools.partial(
+            ccgnlse.integrate_stream_single, order=args.order, **tables,
+            **steady)
+else:
+    import wells.time_dependent as time_dependent
+    precision = {"dtype": dtype, "storage": storage}
+    steady = None
+    if args.steady is not None:
+        steady = time_dependent.SteadyState(args.steady, args.patience)
+    integrate = functools.partial(
+        time_dependent.split_step, order=args.order, steady=steady,
+        schedule=schedule, **precision)
+    integrate_adaptive = functools.partial(
+        time_dependent.split_step_adaptive, **precision)
+    integrate_stream = integrate
+    integrate_ensemble = functools.partial(
+        time_dependent.split_step_ensemble, order=args.order,
+        workers=args.threads, **precision)
+    if args.method == "rk4ip":
+        integrate = functools.partial(time_dependent.rk4ip, **precision)
 
 
 xmin = -128.00
@@ -52,9 +241,7 @@ potential = 1/2 * x**2
 potential[abs(x) >= 10] = 50
 
 
-delta = args.delta
-pump = args.pump
-loss = args.loss
+delta, pump, loss = members[0]
 
 input = s.zeros(x.shape, dtype=complex)
 background = 0
@@ -68,8 +255,21 @@ if args.input is not None:
         input = workspace["solution"]
         background = input[(x > 0.5 * xmax) & (x < 0.75 * xmax)]
         background = s.mean(abs(background))
+    if "final" in workspace.files:
+        # Continuing a run that has recorded only the observables.
+        input = workspace["final"]
+        background = workspace["background"]
     if "states" in workspace.files:
         # Using own data file to extract the input state.
+        if workspace["states"].shape[1] != nx:
+            parser.error("cannot continue from a windowed run")
+        # Unless the run has settled early, the last snapshot is the
+        # final state only if the recorded stride in t ends on maxt.
+        if ("maxt" in workspace.files and
+                not workspace["converged"] and
+                workspace["t"][-1] != workspace["maxt"]):
+            parser.error("cannot continue from a run whose last "
+                         "snapshot is not at its end time, see --sst")
         input = workspace["states"][-1, :]
         background = workspace["background"]
     delta = workspace["delta"]
@@ -77,10 +277,14 @@ if args.input is not None:
     loss = workspace["loss"]
 
 
-filename = (
-    filename +
-    "delta=%.2f_pump=%.2E_loss=%.2E_mint=%.2f_maxt_%.2f_nt=%d_dt=%.2E.npz" %
-    (delta, pump, loss, args.mint, args.maxt, args.nt, args.dt))
+def name(delta, pump, loss):
+    return (
+        "delta=%.2f_pump=%.2E_loss=%.2E_"
+        "mint=%.2f_maxt_%.2f_nt=%d_dt=%.2E.npz" %
+        (delta, pump, loss, args.mint, args.maxt, args.nt, args.dt))
+
+
+filename = filename + name(delta, pump, loss)
 
 
 absorber = (1000 *
@@ -90,26 +294,183 @@ absorber[abs(x) < 64] = 0
 
 
 t = s.linspace(args.mint, args.maxt, args.nt)
-states = ccgnlse.integrate(
-    t, x, input, args.dt,
-    [-delta, 0.0, -1.0],
-    1.0,
-    potential,
-    pump, loss,
-    absorber, background)
+
+
+# Only the part of the solution inside the recorded window is copied
+# into the output, the rest of the domain is the absorber anyway.
+minx = x.min() if args.minx is None else args.minx
+maxx = x.max() if args.maxx is None else args.maxx
+window = {
+    "xstart": s.searchsorted(x, minx),
+    "xstop": s.searchsorted(x, maxx, side="right"),
+    "xstep": args.ssx,
+    "tstep": args.sst
+}
+xs = x[window["xstart"]:window["xstop"]:window["xstep"]]
+ts = t[::window["tstep"]]
+
+
+if args.observe:
+    # Only the time series of the observables are kept, plus the final
+    # state to continue from.
+    probes = [abs(x - probe).argmin() for probe in args.probe]
+    modes = s.zeros((nx, 0))
+    if args.modes > 0:
+        import wells.time_independent as time_independent
+        _, modes = time_independent.cached_fdlp(x, potential, args.modes)
+        modes = modes.real
+        modes /= s.sqrt(util.energy(x, modes.T))
+    ts = t
+    xs = x
+    if args.engine == "fortran":
+        moments, fields, projections, final, trace = ccgnlse.observe(
+            t, x, input, args.dt,
+            [-delta, 0.0, -1.0],
+            1.0,
+            potential,
+            pump, loss,
+            absorber, background,
+            probes, modes,
+            order=args.order,
+            pstep=args.pstep,
+            **tables)
+        series = {
+            "energy": moments[:, 0],
+            "center": moments[:, 1],
+            "width": moments[:, 2],
+            "fields": fields,
+            "projections": projections
+        }
+        if args.pstep:
+            series["trace"] = trace
+            series["ttrace"] = (
+                t[0] + args.pstep * args.dt * s.arange(len(trace)))
+    else:
+        series, observer = util.observer(t, x, probes, modes)
+        prober = None
+        if args.pstep:
+            series["ttrace"], series["trace"], prober = util.prober(
+                t, args.dt, probes, args.pstep)
+        final = s.zeros(nx, dtype=complex)
+
+        def callback(i, y):
+            final[:] = y
+        integrate(
+            t, x, input, args.dt,
+            [-delta, 0.0, -1.0],
+            1.0,
+            potential,
+            pump, loss,
+            absorber, background,
+            callback=callback,
+            observer=observer,
+            prober=prober,
+            pstep=max(args.pstep, 1))
+    series["probes"] = x[probes]
+elif args.stream:
+    # Snapshots go straight into a memory-mapped file, which savez
+    # below copies into the workspace in chunks.
+    stream = filename.replace(".npz", "_states.npy")
+    states, callback = util.memmap_writer(
+        stream, (len(ts), len(xs)), storage)
+    integrate_stream(
+        t, x, input, args.dt,
+        [-delta, 0.0, -1.0],
+        1.0,
+        potential,
+        pump, loss,
+        absorber, background,
+        callback=callback,
+        **window)
+elif ensemble:
+    # The detuning of every member overrides the constant term of the
+    # dispersion operator.
+    deltas, pumps, losses = s.array(members).T
+    states = integrate_ensemble(
+        t, x, s.tile(input, (len(members), 1)), args.dt,
+        [0.0, 0.0, -1.0],
+        1.0,
+        potential,
+        deltas, pumps, losses,
+        absorber, background,
+        **window)
+elif args.rtol is None:
+    states = integrate(
+        t, x, input, args.dt,
+        [-delta, 0.0, -1.0],
+        1.0,
+        potential,
+        pump, loss,
+        absorber, background,
+        **window)
+else:
+    states, accepted, rejected = integrate_adaptive(
+        t, x, input, args.dt,
+        [-delta, 0.0, -1.0],
+        1.0,
+        potential,
+        pump, loss,
+        absorber, background,
+        args.rtol, args.atol,
+        **window)
+
+
+if args.engine == "fortran" and args.wisdom is not None:
+    fftw.export_wisdom(args.wisdom)
+
+
+# If the run has settled early, only the snapshots up to that point
+# are meaningful.
+converged = -1
+if args.steady is not None:
+    if args.engine == "fortran":
+        converged = int(ccgnlse.converged)
+    else:
+        converged = steady.converged
+if converged >= 0:
+    ts = ts[:converged // window["tstep"] + 1]
+    states = states[:len(ts)]
+
+
+if not args.observe:
+    # The Fortran solver returns the precision of the computation.
+    states = states.astype(storage, copy=False)
 
 
 workspace = {}
-workspace["t"] = t
-workspace["x"] = x
-workspace["states"] = states
+workspace["t"] = ts
+workspace["x"] = xs
+if args.observe:
+    workspace["final"] = final
+    workspace.update(series)
+else:
+    workspace["states"] = states
 workspace["input"] = input
 workspace["background"] = background
 workspace["delta"] = delta
 workspace["pump"] = pump
 workspace["loss"] = loss
 workspace["absorber"] = absorber
+workspace["converged"] = converged >= 0
+workspace["maxt"] = t[-1]
+if schedule is not None:
+    workspace["schedule"] = s.array(schedule).T
+if args.rtol is not None:
+    workspace["accepted"] = accepted
+    workspace["rejected"] = rejected
 
 
-s.savez(filename, **workspace)
-print(filename)
+if ensemble:
+    for (delta, pump, loss), states_ in zip(members, states):
+        workspace["states"] = states_
+        workspace["delta"] = delta
+        workspace["pump"] = pump
+        workspace["loss"] = loss
+        filename = name(delta, pump, loss)
+        s.savez(filename, **workspace)
+        print(filename)
+else:
+    s.savez(filename, **workspace)
+    if args.stream:
+        os.remove(stream)
+    print(filename)
@@ -1,13 +1,20 @@
 #!/bin/bash
 
 
+# Usage: propagate.sh INPUT [PROPAGATE.PY OPTIONS...]. The segments
+# are chained until t = 600 or until a segment reports that it has
+# converged to a steady state (see --steady).
 input=$1;
+shift;
 mint=0;
 maxt=50;
 
 
 while [ $maxt -le 600 ]; do
-    input=`./propagate.py --mint $mint --maxt $maxt --nt $((2**12)) --input $input`;
+    input=`./propagate.py --mint $mint --maxt $maxt --nt $((2**12)) --input $input "$@"`;
+    if python3 -c "import sys, numpy; sys.exit(not numpy.load(sys.argv[1])['converged'])" $input; then
+        break;
+    fi;
     mint=`expr $mint + 50`;
     maxt=`expr $maxt + 50`;
 done;
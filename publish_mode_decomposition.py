@@ -44,45 +44,45 @@ args = parser.parse_args()
 workspace = scipy.load(args.input)
 t = workspace["t"]
 x = workspace["x"]
-states = workspace["states"]
 
 
-u = scipy.zeros(x.shape)
-u = 1/2 * x**2
-u[abs(x) >= 10] = 50
+if "projections" in workspace.files:
+    # The projections and the energy were recorded by the solver.
+    coefficients = abs(workspace["projections"][:, :args.num])
+    energy = workspace["energy"]
+    mode_numbers = scipy.arange(coefficients.shape[1])
+else:
+    states = workspace["states"]
 
-eigenvalues, eigenvectors = time_independent.fdlp(
-    x, u, args.num + 1, boundary="box")
-eigenvectors = eigenvectors.real
+    u = scipy.zeros(x.shape)
+    u = 1/2 * x**2
+    u[abs(x) >= 10] = 50
 
-for n in range(args.num + 1):
-    eigenvalue = eigenvalues[n]
-    eigenvector = eigenvectors[:, n]
-    eigenvector /= scipy.sqrt(util.energy(x, eigenvector))
-    eigenvectors[:, n] = eigenvector
+    eigenvalues, eigenvectors = time_independent.cached_fdlp(
+        x, u, args.num + 1, boundary="box")
+    eigenvectors = eigenvectors.real
 
+    for n in range(args.num + 1):
+        eigenvalue = eigenvalues[n]
+        eigenvector = eigenvectors[:, n]
+        eigenvector /= scipy.sqrt(util.energy(x, eigenvector))
+        eigenvectors[:, n] = eigenvector
 
-mode_numbers = scipy.arange(args.num)
+    mode_numbers = scipy.arange(args.num)
 
-coefficients = scipy.zeros((len(t), len(mode_numbers)))
-for n in mode_numbers:
-    eigenvector = eigenvectors[:, n]
-    for idx, _ in enumerate(t):
-        state = states[idx, :]
-        coefficient = scipy.trapz(eigenvector * state, x)
-        coefficients[idx, n] = abs(coefficient)
-# coefficients[coefficients == 0] = None
-# coefficients = scipy.log10(coefficients)
+    coefficients = scipy.zeros((len(t), len(mode_numbers)))
+    for n in mode_numbers:
+        coefficients[:, n] = abs(scipy.trapz(eigenvectors[:, n] * states, x))
+    # coefficients[coefficients == 0] = None
+    # coefficients = scipy.log10(coefficients)
+
+    energy = util.energy(x, states)
 
 
 estimate = scipy.zeros(len(t))
 for n in mode_numbers:
     estimate += coefficients[:, n]**2
 
-energy = scipy.zeros(len(t))
-for idx, _ in enumerate(t):
-    energy[idx] = util.energy(x, states[idx, :])
-
 
 # Sort the modes by maximum value at zero.
 idx = scipy.argsort(coefficients[0])[::-1]
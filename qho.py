@@ -11,7 +11,8 @@ u = scipy.zeros(x.shape)
 u = 1/2 * x**2
 
 n = 32
-eigenvalues, eigenvectors = time_independent.fdlp(x, u, n, boundary="box")
+eigenvalues, eigenvectors = time_independent.cached_fdlp(
+    x, u, n, boundary="box")
 
 
 plot.figure()
@@ -11,12 +11,15 @@ input = sys.argv[2]
 
 ws = scipy.load(input)
 t = ws["t"]
-x = ws["x"]
-y = ws["states"]
-
-
-idx = abs(x - z0).argmin()
-y = y[:, idx]
+if "fields" in ws.files:
+    # Only the observables were recorded, take the nearest probe.
+    x = ws["probes"]
+    idx = abs(x - z0).argmin()
+    y = ws["fields"][:, idx]
+else:
+    x = ws["x"]
+    idx = abs(x - z0).argmin()
+    y = ws["states"][:, idx]
 
 
 output = scipy.zeros((len(t), 3))
@@ -3,7 +3,7 @@
 
 import argparse
 import scipy
-import scipy.sparse as sparse
+import scipy.linalg
 import scipy.sparse.linalg as linalg
 import wells.util as util
 
@@ -27,6 +27,10 @@ try:
     loss = workspace["loss"]
 except:
     loss = 0
+try:
+    order = int(workspace["order"])
+except:
+    order = 2
 
 
 x = x[::2]
@@ -49,23 +53,66 @@ if args.trust:
 
 
 nx = len(x)
-dx = x[1] - x[0]
-
-
-laplacian = util.laplacian(nx, dx)
-potential = sparse.diags(potential, 0, (nx, nx))
-power = sparse.diags(abs(solution)**2, 0)
-square = sparse.diags(solution**2, 0)
-delta = delta * sparse.eye(nx, nx)
-loss = loss * sparse.eye(nx, nx)
-
-l = -1/2 * laplacian + potential - 2*power + delta
-operator = sparse.bmat(
-    [[l - 1j * loss, -square],
-     [square.conjugate(), -l - 1j * loss]])
+hamiltonian = util.Hamiltonian(x, potential, order=order)
+power = abs(solution)**2
+square = solution**2
+
+# Linearization around the solution, the operator
+#
+#   [[l - 1j*loss, -square], [conj(square), -l - 1j*loss]]
+#
+# with l = H - 2*power + delta, applied matrix-free. The diagonal
+# blocks only differ from the Hamiltonian by the diagonal shifts.
+shift = delta - 2*power - 1j*loss
+shift_ = delta - 2*power + 1j*loss
+
+
+def matvec(v):
+    v = scipy.ravel(v)
+    a = v[:nx]
+    b = v[nx:]
+    result = scipy.empty(2*nx, dtype=complex)
+    hamiltonian.apply(a, shift, out=result[:nx])
+    hamiltonian.apply(b, shift_, out=result[nx:])
+    result[nx:] *= -1
+    result[:nx] -= square * b
+    result[nx:] += square.conj() * a
+    return result
+
+
+# The eigenvalues of the smallest magnitude are found in shift-invert
+# mode around zero. With the two components of the perturbation
+# interleaved the operator is banded, twice as wide as the
+# Hamiltonian, and is solved as such by LAPACK.
+bands = hamiltonian.bands()
+m = 2 * (len(bands) - 1)
+full = scipy.zeros((2*m + 1, 2*nx), dtype=complex)
+full[m, 0::2] = bands[0] + shift
+full[m, 1::2] = -(bands[0] + shift_)
+full[m-1, 1::2] = -square
+full[m+1, 0::2] = square.conj()
+for k in range(1, len(bands)):
+    for row in (m - 2*k, m + 2*k):
+        full[row, 0::2] = bands[k, 0]
+        full[row, 1::2] = -bands[k, 0]
+
+
+def solve(v):
+    v = scipy.ravel(v)
+    w = scipy.empty(2*nx, dtype=complex)
+    w[0::2] = v[:nx]
+    w[1::2] = v[nx:]
+    w = scipy.linalg.solve_banded(
+        (m, m), full, w, overwrite_b=True, check_finite=False)
+    return scipy.concatenate((w[0::2], w[1::2]))
+
+
+operator = linalg.LinearOperator((2*nx, 2*nx), matvec, dtype=complex)
+inverse = linalg.LinearOperator((2*nx, 2*nx), solve, dtype=complex)
 
 k = 64
-eigenvalues, eigenvectors = linalg.eigs(operator, k=k, which="SM")
+eigenvalues, eigenvectors = linalg.eigs(
+    operator, k=k, sigma=0, which="LM", OPinv=inverse)
 stable = all(eigenvalues.imag < 0)
 
 
@@ -5,7 +5,6 @@ import argparse
 
 import scipy
 import scipy.optimize as optimize
-import scipy.sparse as sparse
 
 import wells.time_independent as time_independent
 import wells.util as util
@@ -23,14 +22,22 @@ parser.add_argument("--n",
                     help="Mode number",
                     type=int,
                     default=0)
+parser.add_argument("--nx",
+                    help="Number of grid points",
+                    type=int,
+                    default=2**12)
+parser.add_argument("--order",
+                    help="Order of the finite-difference Laplacian",
+                    type=int,
+                    choices=[2, 4, 6, 8],
+                    default=2)
 args = parser.parse_args()
 
 
 # Coordinate grid parameters.
 minx = -32
 maxx = +32
-nx = 2**12
-dx = (minx - maxx) / (nx - 1)
+nx = args.nx
 
 # Coordinate grid.
 x = scipy.linspace(minx, maxx, nx)
@@ -48,42 +55,28 @@ if args.input is not None:
     solution = workspace["solution"]
 
 
-# Find the first n eigenstates to use as starting point.
-eigenvalues, eigenvectors = time_independent.fdlp(
-    x, u, args.n + 1, boundary="box")
-eigenvectors = eigenvectors.real
+# Find the n-th eigenstate to use as starting point.
+eigenvalues, eigenvectors = time_independent.cached_fdlp(
+    x, u, 1, boundary="box", first=args.n, order=args.order)
+eigenvalue = eigenvalues[0]
+eigenvector = eigenvectors[:, 0].real
 
-# Normalize the modes.
-for n in range(args.n + 1):
-    eigenvalue = eigenvalues[n]
-    eigenvector = eigenvectors[:, n]
-    eigenvector = (
-        scipy.sqrt(
-            abs(eigenvalue) /
-            util.energy(x, eigenvector)) *
-        eigenvector)
-    eigenvectors[:, n] = eigenvector
+# Normalize the mode.
+eigenvector = (
+    scipy.sqrt(
+        abs(eigenvalue) /
+        util.energy(x, eigenvector)) *
+    eigenvector)
 
 
 # Define operators for the Newton-CG method.
-laplacian = util.laplacian(nx, dx)
-potential = sparse.diags(u, 0, (nx, nx))
-delta = args.delta * sparse.eye(nx, nx)
+hamiltonian = util.Hamiltonian(x, u, order=args.order)
 
 
 # Nonlinear operator.
 def l0(state):
-    focusing = sparse.diags(abs(state)**2, 0, (nx, nx))
-    operator = (
-        -1/2 * laplacian +
-        potential -
-        focusing +
-        delta)
-    return operator.dot(state)
-
+    return hamiltonian.apply(state, args.delta - abs(state)**2)
 
-eigenvalue = eigenvalues[args.n]
-eigenvector = eigenvectors[:, args.n]
 if args.input is not None and util.energy(x, solution) > 0.1:
     initial = solution
 else:
@@ -103,6 +96,7 @@ workspace["n"] = args.n
 workspace["eigenvalue"] = eigenvalue
 workspace["eigenvector"] = eigenvector
 workspace["delta"] = args.delta
+workspace["order"] = args.order
 workspace["solution"] = solution
 
 
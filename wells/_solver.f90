@@ -2,46 +2,301 @@ module fftw
   implicit none
   include "fftw3.f"
 
-  integer*8, private :: fft_plan = 0
-  integer*8, private :: ifft_plan = 0
+  ! Plan cache. A plan is only valid for the transform size, the
+  ! number of transforms, the direction and the precision it was
+  ! created for, and for arrays with the same alignment and placement
+  ! (in-place or out-of-place) as the ones it was created with, so all
+  ! of them make up the key. The precision is the kind of the complex
+  ! arrays, 8 for the double precision plans of dfftw and 4 for the
+  ! single precision ones of sfftw. When the cache is full the oldest
+  ! plan is destroyed.
+  integer, parameter, private :: max_plans = 32
+  integer, parameter, private :: alignment = 64
+  integer, private :: nplans = 0
+  integer, private :: oldest = 1
+  integer*8, dimension(max_plans), private :: plans = 0
+  integer, dimension(max_plans), private :: plan_sizes = 0
+  integer, dimension(max_plans), private :: plan_batches = 0
+  integer, dimension(max_plans), private :: plan_directions = 0
+  integer, dimension(max_plans), private :: plan_alignments = 0
+  integer, dimension(max_plans), private :: plan_kinds = 0
+
+  ! Planning rigor, see set_rigor().
+  integer, private :: rigor = FFTW_ESTIMATE
+
+  ! Multi-threading, see set_threads().
+  integer, private :: threads_initialized = 0
+
+  private :: placement, lookup, destroy
 contains
-  subroutine fftinit(input, output)
-    double complex, dimension(:) :: input
-    double complex, dimension(:) :: output
-    call dfftw_plan_dft_1d(     &
-         fft_plan, size(input), &
-         input, output,         &
-         FFTW_FORWARD, FFTW_ESTIMATE)
-  end subroutine fftinit
+  subroutine set_threads(n)
+    ! Set the number of threads used by the FFTs and by the OpenMP
+    ! loops of the solver. Plans made for another number of threads
+    ! are dropped.
+    !$ use omp_lib
+    integer, intent(in) :: n
+    if (threads_initialized == 0) then
+       call dfftw_init_threads(threads_initialized)
+       if (threads_initialized /= 0) then
+          call sfftw_init_threads(threads_initialized)
+       end if
+    end if
+    if (threads_initialized == 0) then
+       write (0, "('FFTW threads initialization failed')")
+       return
+    end if
+    call dfftw_plan_with_nthreads(n)
+    call sfftw_plan_with_nthreads(n)
+    !$ call omp_set_num_threads(n)
+    call forget_plans()
+  end subroutine set_threads
+
+  subroutine set_rigor(name)
+    ! Select the planner flag by name: estimate, measure, patient or
+    ! exhaustive. Plans made with a different rigor are dropped.
+    character(len=*), intent(in) :: name
+    select case (name)
+    case ("estimate")
+       rigor = FFTW_ESTIMATE
+    case ("measure")
+       rigor = FFTW_MEASURE
+    case ("patient")
+       rigor = FFTW_PATIENT
+    case ("exhaustive")
+       rigor = FFTW_EXHAUSTIVE
+    case default
+       write (0, "('Unknown FFTW planner rigor: ' A)") name
+       return
+    end select
+    call forget_plans()
+  end subroutine set_rigor
+
+  subroutine forget_plans()
+    ! Destroy all the cached plans.
+    integer :: i
+    do i = 1, nplans
+       call destroy(i)
+    end do
+    plans = 0
+    nplans = 0
+    oldest = 1
+  end subroutine forget_plans
+
+  subroutine destroy(i)
+    ! Destroy the i-th cached plan with the library that made it.
+    integer :: i
+    if (plan_kinds(i) == 4) then
+       call sfftw_destroy_plan(plans(i))
+    else
+       call dfftw_destroy_plan(plans(i))
+    end if
+  end subroutine destroy
+
+  subroutine import_wisdom(filename, success)
+    ! Import accumulated wisdom from a file. Plans made after that
+    ! with the same (or lower) rigor are created instantly. The
+    ! wisdom only covers the double precision plans.
+    use iso_c_binding
+    character(len=*), intent(in) :: filename
+    logical, intent(out) :: success
+    interface
+       integer(c_int) function fftw_import_wisdom_from_filename(name) &
+            bind(C, name="fftw_import_wisdom_from_filename")
+         import :: c_int, c_char
+         character(kind=c_char), dimension(*) :: name
+       end function fftw_import_wisdom_from_filename
+    end interface
+    success = fftw_import_wisdom_from_filename( &
+         trim(filename) // c_null_char) /= 0
+  end subroutine import_wisdom
 
-  subroutine ifftinit(input, output)
+  subroutine export_wisdom(filename, success)
+    ! Export wisdom gathered by the planner to a file.
+    use iso_c_binding
+    character(len=*), intent(in) :: filename
+    logical, intent(out) :: success
+    interface
+       integer(c_int) function fftw_export_wisdom_to_filename(name) &
+            bind(C, name="fftw_export_wisdom_to_filename")
+         import :: c_int, c_char
+         character(kind=c_char), dimension(*) :: name
+       end function fftw_export_wisdom_to_filename
+    end interface
+    success = fftw_export_wisdom_to_filename( &
+         trim(filename) // c_null_char) /= 0
+  end subroutine export_wisdom
+
+  function plan(input, output, direction)
+    ! Find the plan for the given arrays in the cache, or create one.
     double complex, dimension(:) :: input
     double complex, dimension(:) :: output
-    call dfftw_plan_dft_1d(      &
-         ifft_plan, size(input), &
-         input, output,          &
-         FFTW_BACKWARD, FFTW_ESTIMATE)
-  end subroutine ifftinit
+    integer :: direction
+    integer*8 :: plan
+    plan = plan_many(input, output, size(input), 1, direction)
+  end function plan
+
+  integer function placement(input, output)
+    ! Alignment of both arrays and placement packed into one number,
+    ! given the addresses of the arrays.
+    integer*8 :: input, output
+    placement = int(mod(input, int(alignment, 8)))
+    placement = alignment * placement + int(mod(output, int(alignment, 8)))
+    if (input == output) then
+       placement = - placement - 1
+    end if
+  end function placement
+
+  logical function lookup(n, howmany, direction, key, kind, i)
+    ! Find the plan with the given key in the cache. If there is none,
+    ! i is set to a free slot, the oldest plan being destroyed to make
+    ! one if the cache is full, and the slot is given the key.
+    integer :: n, howmany, direction, key, kind, i
+
+    do i = 1, nplans
+       if (plan_sizes(i) == n .and.                 &
+           plan_batches(i) == howmany .and.         &
+           plan_directions(i) == direction .and.    &
+           plan_alignments(i) == key .and.          &
+           plan_kinds(i) == kind) then
+          lookup = .TRUE.
+          return
+       end if
+    end do
+    lookup = .FALSE.
+
+    if (nplans < max_plans) then
+       nplans = nplans + 1
+       i = nplans
+    else
+       i = oldest
+       oldest = mod(oldest, max_plans) + 1
+       call destroy(i)
+    end if
+    plan_sizes(i) = n
+    plan_batches(i) = howmany
+    plan_directions(i) = direction
+    plan_alignments(i) = key
+    plan_kinds(i) = kind
+  end function lookup
+
+  function plan_many(input, output, n, howmany, direction)
+    ! Same as plan(), but for howmany transforms of size n of the
+    ! consecutive columns of n-by-howmany matrices, all of which are
+    ! done by a single execution of the plan.
+    integer :: n, howmany, direction
+    double complex, dimension(n * howmany) :: input
+    double complex, dimension(n * howmany) :: output
+    integer*8 :: plan_many
+
+    double complex, dimension(:), allocatable :: backup
+    integer :: i
+
+    if (lookup(n, howmany, direction, placement(loc(input), loc(output)), &
+         8, i)) then
+       plan_many = plans(i)
+       return
+    end if
+
+    ! Planning with anything but FFTW_ESTIMATE overwrites the arrays,
+    ! so the input is saved and restored around it.
+    allocate(backup(size(input)))
+    backup = input
+    call dfftw_plan_many_dft(            &
+         plans(i), 1, n, howmany,        &
+         input, n, 1, n,                 &
+         output, n, 1, n,                &
+         direction, rigor)
+    input = backup
+    deallocate(backup)
+    plan_many = plans(i)
+  end function plan_many
+
+  function plan_single(input, output, direction)
+    ! Same as plan(), but for single precision arrays.
+    complex, dimension(:) :: input
+    complex, dimension(:) :: output
+    integer :: direction
+    integer*8 :: plan_single
+
+    complex, dimension(:), allocatable :: backup
+    integer :: i
+
+    if (lookup(size(input), 1, direction, &
+         placement(loc(input), loc(output)), 4, i)) then
+       plan_single = plans(i)
+       return
+    end if
+
+    allocate(backup(size(input)))
+    backup = input
+    call sfftw_plan_dft_1d(plans(i), size(input), input, output, &
+         direction, rigor)
+    input = backup
+    deallocate(backup)
+    plan_single = plans(i)
+  end function plan_single
 
   subroutine fft(input, output)
     double complex, dimension(:) :: input
     double complex, dimension(:) :: output
-    if (fft_plan == 0) then
-       call fftinit(input, output)
-    end if
-    call dfftw_execute_dft(fft_plan, input, output)
+    call dfftw_execute_dft(plan(input, output, FFTW_FORWARD), input, output)
   end subroutine fft
 
   subroutine ifft(input, output)
     double complex, dimension(:) :: input
     double complex, dimension(:) :: output
-    if (ifft_plan == 0) then
-       call ifftinit(input, output)
-    end if
-    call dfftw_execute_dft(ifft_plan, input, output)
-    output = output / size(output)
+    integer :: i
+    call dfftw_execute_dft(plan(input, output, FFTW_BACKWARD), input, output)
+    !$omp parallel do
+    do i = 1, size(output)
+       output(i) = output(i) / size(output)
+    end do
+    !$omp end parallel do
   end subroutine ifft
 
+  subroutine fft_single(input, output)
+    complex, dimension(:) :: input
+    complex, dimension(:) :: output
+    call sfftw_execute_dft( &
+         plan_single(input, output, FFTW_FORWARD), input, output)
+  end subroutine fft_single
+
+  subroutine ifft_single(input, output)
+    complex, dimension(:) :: input
+    complex, dimension(:) :: output
+    integer :: i
+    call sfftw_execute_dft( &
+         plan_single(input, output, FFTW_BACKWARD), input, output)
+    !$omp parallel do
+    do i = 1, size(output)
+       output(i) = output(i) / size(output)
+    end do
+    !$omp end parallel do
+  end subroutine ifft_single
+
+  subroutine fft_many(input, output)
+    ! Forward transforms of all the columns of input at once.
+    double complex, dimension(:, :) :: input
+    double complex, dimension(:, :) :: output
+    integer*8 :: p
+    p = plan_many(input, output, size(input, 1), size(input, 2), &
+         FFTW_FORWARD)
+    call dfftw_execute_dft(p, input, output)
+  end subroutine fft_many
+
+  subroutine ifft_many(input, output)
+    ! Backward transforms of all the columns of input at once. Unlike
+    ! ifft() they are not normalized, the caller is expected to fold
+    ! the factor 1/n into its own products, which saves a pass over
+    ! the data.
+    double complex, dimension(:, :) :: input
+    double complex, dimension(:, :) :: output
+    integer*8 :: p
+    p = plan_many(input, output, size(input, 1), size(input, 2), &
+         FFTW_BACKWARD)
+    call dfftw_execute_dft(p, input, output)
+  end subroutine ifft_many
+
   subroutine fftfreq(n, step, f)
     integer :: n
     double precision :: step
@@ -100,7 +355,875 @@ module ccgnlse
   use fftw
   use util
   implicit none
+
+  ! Medium parameters and work buffers shared by the stepping
+  ! routines. They are filled in by setup() at the beginning of every
+  ! integration and released by teardown() at the end.
+  double precision, private :: gamma_, pump_, loss_, bg_
+  double precision, allocatable, dimension(:), private :: d_, u_, absrb_
+  double complex, allocatable, dimension(:), private :: s_
+  logical, private :: use_u_, use_absrb_
+
+  ! Support of the absorber: the absorber is nonzero only within the
+  ! index ranges ranges_(1, k) to ranges_(2, k). Filled in by
+  ! support().
+  integer, allocatable, dimension(:, :), private :: ranges_
+
+  ! Splitting scheme: the step is D(a(0)) N(b(1)) D(a(1)) ... N(b(m))
+  ! D(a(m)), where D and N are the dispersive and nonlinear substeps
+  ! and the coefficients are fractions of the full step.
+  double precision, allocatable, dimension(:), private :: a_, b_
+
+  ! Dispersive substep propagators for the current scheme and step,
+  ! plus the one that merges the closing substep of a step with the
+  ! opening substep of the next one. Filled in by substeps().
+  double complex, allocatable, dimension(:, :), private :: e_
+  double complex, allocatable, dimension(:), private :: ef_
+
+  ! Combined linear factors of the potential and the losses,
+  ! exp(-(im*u + loss)*h), for every nonlinear substep of the scheme.
+  ! Filled in by substeps() as well.
+  double complex, allocatable, dimension(:, :), private :: l_
+
+  ! Single precision copies of e_, ef_ and l_ and the spectrum buffer
+  ! of the single precision integrators, which set single_. The
+  ! propagators are computed in double precision and rounded, so that
+  ! their phases stay accurate for large dispersion. Filled in by
+  ! substeps() too.
+  logical, private :: single_ = .FALSE.
+  complex, allocatable, dimension(:, :), private :: es_, ls_
+  complex, allocatable, dimension(:), private :: efs_, ss_
+
+  ! Recorded part of the solution: every tstep_-th snapshot of the
+  ! points xfirst_, xfirst_ + xstep_, ..., xlast_, nw_ points in
+  ! total. Filled in by window().
+  integer, private :: xfirst_, xlast_, xstep_, tstep_, nw_
+
+  ! Steady state monitor: amplitude of the last recorded snapshot and
+  ! the number of consecutive recorded snapshots that did not differ
+  ! from the previous ones by more than the tolerance.
+  double precision, allocatable, dimension(:), private :: prev_
+  integer, private :: calm_
+
+  ! High-rate probes: the field at the points probes_ is recorded
+  ! into trace_ after every pstep_-th internal step, pstep_ = 0 turns
+  ! the probes off. Set up by observe().
+  integer, allocatable, dimension(:), private :: probes_
+  integer, private :: pstep_ = 0
+  double complex, allocatable, dimension(:, :), private :: trace_
+
+  ! Parameter schedules: piecewise-linear tables of the detuning,
+  ! pump and loss against time, set by schedule() from the tables
+  ! passed to the fixed step integrators and released by teardown().
+  ! When set, they override -betas(1), pump and loss, the values
+  ! being taken at the middle of every output interval. delta_ is the
+  ! detuning the current d_ corresponds to.
+  double precision, allocatable, dimension(:), private :: times_
+  double precision, allocatable, dimension(:), private :: deltas_
+  double precision, allocatable, dimension(:), private :: pumps_, losses_
+  double precision, private :: delta_
+
+  ! Zero-based index in t of the snapshot at which the last fixed
+  ! step integration stopped on a steady state, -1 if it ran to the
+  ! end.
+  integer :: converged = -1
+
+  private :: window, recorded, snapshot, support, kick, settle, &
+       measure, probe, interpolate, update, snapshots, &
+       dispersive_steps, advance_ensemble, setup, teardown, &
+       splitting, substeps, advance, linear_factor, dispersive_step, &
+       nonlinear_step, nonlinear_term, term, schedule, snapshot_single, &
+       dispersive_step_single, kick_single, nonlinear_step_single, &
+       advance_single
 contains
+  subroutine window(xstart, xstop, xstep, tstep)
+    ! Set up the recorded window. The arguments follow the Python
+    ! slicing convention: the snapshots contain x[xstart:xstop:xstep]
+    ! at the times t[::tstep].
+    integer, intent(in) :: xstart, xstop, xstep, tstep
+    xfirst_ = xstart + 1
+    xlast_ = xstop
+    xstep_ = xstep
+    tstep_ = tstep
+    nw_ = (xstop - xstart - 1) / xstep + 1
+  end subroutine window
+
+  logical function recorded(i)
+    ! Whether the snapshot with the (one-based) time index i is kept.
+    integer, intent(in) :: i
+    recorded = mod(i - 1, tstep_) == 0
+  end function recorded
+
+  subroutine snapshot(ys, i, y)
+    ! Store the recorded window of y as the i-th snapshot, if that one
+    ! is kept at all. The output matrices are C-ordered (nt, nw)
+    ! arrays on the Python side (intent(c)), which in memory is the
+    ! same as a Fortran nw-by-nt matrix. Viewing them that way makes
+    ! both the snapshot writes here and the row reads in numpy
+    ! contiguous.
+    integer :: i
+    double complex, dimension(nw_, *) :: ys
+    double complex, dimension(:) :: y
+    if (recorded(i)) then
+       ys(:, (i - 1)/tstep_ + 1) = y(xfirst_:xlast_:xstep_)
+    end if
+  end subroutine snapshot
+
+  subroutine snapshot_single(ys, i, y)
+    ! snapshot() for the single precision integrators.
+    integer :: i
+    complex, dimension(nw_, *) :: ys
+    complex, dimension(:) :: y
+    if (recorded(i)) then
+       ys(:, (i - 1)/tstep_ + 1) = y(xfirst_:xlast_:xstep_)
+    end if
+  end subroutine snapshot_single
+
+  subroutine snapshots(ys, nr, i, y)
+    ! snapshot() for the members of an ensemble, the columns of y. The
+    ! output is a C-ordered (nb, nr, nw) array on the Python side, nr
+    ! being the number of the recorded snapshots, so every member gets
+    ! its own contiguous matrix of snapshots.
+    integer :: nr, i
+    double complex, dimension(nw_, nr, *) :: ys
+    double complex, dimension(:, :) :: y
+    integer :: b
+    if (recorded(i)) then
+       do b = 1, size(y, 2)
+          ys(:, (i - 1)/tstep_ + 1, b) = y(xfirst_:xlast_:xstep_, b)
+       end do
+    end if
+  end subroutine snapshots
+
+  subroutine settle(y, i, tol, patience, done)
+    ! Check whether the integration can stop at the (one-based) time
+    ! index i, which it can once the relative change of abs(y)
+    ! between the recorded snapshots has stayed below tol for patience
+    ! snapshots in a row. Snapshots that are not recorded are not
+    ! looked at, so that the last recorded one is always the final
+    ! state. The call with i = 1 initializes the monitor, tol = 0
+    ! disables it altogether.
+    double complex, dimension(:) :: y
+    integer :: i, patience
+    double precision :: tol
+    logical :: done
+    double precision :: change
+
+    done = .FALSE.
+    if (tol <= 0 .or. .not. recorded(i)) then
+       return
+    end if
+    if (i == 1) then
+       if (allocated(prev_)) then
+          deallocate(prev_)
+       end if
+       allocate(prev_(size(y)))
+       prev_ = abs(y)
+       calm_ = 0
+       return
+    end if
+
+    change = maxval(abs(abs(y) - prev_)) / max(maxval(abs(y)), tiny(tol))
+    prev_ = abs(y)
+    if (change < tol) then
+       calm_ = calm_ + 1
+    else
+       calm_ = 0
+    end if
+    done = calm_ >= patience
+  end subroutine settle
+
+  subroutine measure(y, i, x, w, probes, modes, moments, fields, projections)
+    ! Evaluate the observables of y into the i-th row of the outputs
+    ! of observe(): the energy, the centre of mass and the width of
+    ! the field, the field at the probe points and its projections on
+    ! the modes. Same as with snapshot(), the outputs are C-ordered on
+    ! the Python side, so their rows are the Fortran columns here. w
+    ! are the trapezoidal quadrature weights.
+    double complex, dimension(:) :: y
+    integer :: i
+    double precision, dimension(:) :: x, w
+    integer, dimension(:) :: probes
+    double precision, dimension(:, :) :: modes
+    double precision, dimension(3, *) :: moments
+    double complex, dimension(size(probes), *) :: fields
+    double complex, dimension(size(modes, 2), *) :: projections
+    double precision :: energy, center, width
+
+    energy = sum(w * abs(y)**2)
+    center = 0
+    width = 0
+    if (energy > 0) then
+       center = sum(w * x * abs(y)**2) / energy
+       width = sqrt(sum(w * (x - center)**2 * abs(y)**2) / energy)
+    end if
+    moments(:, i) = [energy, center, width]
+    fields(:, i) = y(probes + 1)
+    projections(:, i) = matmul(w * y, modes)
+  end subroutine measure
+
+  subroutine probe(y, steps)
+    ! Record the field at the probe points after the given number of
+    ! internal steps, if this step is probed.
+    double complex, dimension(:) :: y
+    integer*8 :: steps
+    integer :: k
+    if (pstep_ <= 0) then
+       return
+    end if
+    if (mod(steps, int(pstep_, 8)) /= 0) then
+       return
+    end if
+    k = int(steps / pstep_) + 1
+    if (k <= size(trace_, 2)) then
+       trace_(:, k) = y(probes_ + 1)
+    end if
+  end subroutine probe
+
+  subroutine schedule(times, deltas, pumps, losses)
+    ! Set the parameter schedules for the current integration. times
+    ! must be increasing, outside of them the first and the last
+    ! values are kept. Empty tables mean no schedules.
+    double precision, dimension(:), intent(in) :: times
+    double precision, dimension(:), intent(in) :: deltas, pumps, losses
+    if (allocated(times_)) then
+       deallocate(times_)
+       deallocate(deltas_)
+       deallocate(pumps_)
+       deallocate(losses_)
+    end if
+    if (size(times) == 0) then
+       return
+    end if
+    allocate(times_(size(times)))
+    allocate(deltas_(size(times)))
+    allocate(pumps_(size(times)))
+    allocate(losses_(size(times)))
+    times_ = times
+    deltas_ = deltas
+    pumps_ = pumps
+    losses_ = losses
+  end subroutine schedule
+
+  double precision function interpolate(values, t)
+    ! Piecewise-linear interpolation of a schedule at the time t.
+    double precision, dimension(:) :: values
+    double precision :: t
+    integer :: n, k
+    n = size(times_)
+    if (t <= times_(1)) then
+       interpolate = values(1)
+       return
+    end if
+    if (t >= times_(n)) then
+       interpolate = values(n)
+       return
+    end if
+    k = 1
+    do while (times_(k+1) < t)
+       k = k + 1
+    end do
+    interpolate = values(k) + (values(k+1) - values(k)) &
+         * (t - times_(k)) / (times_(k+1) - times_(k))
+  end function interpolate
+
+  subroutine update(t, dt)
+    ! Take the parameters from the schedules at the time t. The
+    ! detuning is the constant term of the dispersion operator, so a
+    ! change only shifts d_, but then the substep propagators and the
+    ! linear factors, which also depend on the loss, have to be
+    ! recomputed. Nothing is recomputed if neither has changed.
+    double precision :: t, dt
+    double precision :: delta, loss
+    logical :: changed
+    if (.not. allocated(times_)) then
+       return
+    end if
+    delta = interpolate(deltas_, t)
+    loss = interpolate(losses_, t)
+    pump_ = interpolate(pumps_, t)
+    changed = delta /= delta_ .or. loss /= loss_
+    d_ = d_ - (delta - delta_)
+    delta_ = delta
+    loss_ = loss
+    if (changed) then
+       call substeps(dt)
+    end if
+  end subroutine update
+
+  subroutine splitting(order, optimized)
+    ! Fill in the coefficients of the symmetric splitting scheme of
+    ! the given order. The higher orders are either compositions of
+    ! the Strang step due to Yoshida (triple jump for the 4th order,
+    ! solution A for the 6th one), or the optimized schemes with
+    ! smaller error constants: the 6-stage method of Blanes and Moan
+    ! for the 4th order and the 9-stage composition of Kahan and Li
+    ! for the 6th order.
+    integer :: order
+    logical :: optimized
+
+    double precision, dimension(:), allocatable :: w
+    double precision :: w1
+    integer :: m, j
+
+    if (allocated(a_)) then
+       deallocate(a_)
+       deallocate(b_)
+    end if
+
+    if (order == 4 .and. optimized) then
+       allocate(a_(0:6))
+       allocate(b_(1:6))
+       a_(0:2) = (/ 0.0792036964311957d0,   &
+                    0.353172906049774d0,    &
+                   -0.0420650803577195d0 /)
+       a_(3) = 1 - 2 * sum(a_(0:2))
+       a_(4:6) = a_(2:0:-1)
+       b_(1:2) = (/ 0.209515106613362d0,    &
+                   -0.143851773179818d0 /)
+       b_(3) = 0.5d0 - sum(b_(1:2))
+       b_(4:6) = b_(3:1:-1)
+       return
+    end if
+
+    ! Otherwise the scheme is a symmetric composition of Strang steps
+    ! with the weights w.
+    select case (order)
+    case (4)
+       allocate(w(3))
+       w1 = 1 / (2 - 2**(1.0d0/3))
+       w = (/ w1, 1 - 2*w1, w1 /)
+    case (6)
+       allocate(w(9))
+       if (optimized) then
+          w(1:4) = (/ 0.39216144400731413928d0,  &
+                      0.33259913678935943860d0,  &
+                     -0.70624617255763935981d0,  &
+                      0.082213596293550800230d0 /)
+          w(5) = 1 - 2 * sum(w(1:4))
+          w(6:9) = w(4:1:-1)
+       else
+          deallocate(w)
+          allocate(w(7))
+          w(1:3) = (/ 0.784513610477560d0,  &
+                      0.235573213359357d0,  &
+                     -1.17767998417887d0 /)
+          w(4) = 1 - 2 * sum(w(1:3))
+          w(5:7) = w(3:1:-1)
+       end if
+    case default
+       allocate(w(1))
+       w = 1.0
+    end select
+
+    m = size(w)
+    allocate(a_(0:m))
+    allocate(b_(1:m))
+    b_ = w
+    a_(0) = w(1) / 2
+    do j = 1, m-1
+       a_(j) = (w(j) + w(j+1)) / 2
+    end do
+    a_(m) = w(m) / 2
+    deallocate(w)
+  end subroutine splitting
+
+  subroutine setup(x, betas, gamma, u, pump, loss, absrb, bg)
+    double precision, dimension(:), intent(in) :: x
+    double precision, dimension(:), intent(in) :: betas, u, absrb
+    double precision, intent(in) :: gamma, pump, loss, bg
+
+    integer :: nx, i, n
+    double precision :: dx
+    double precision, dimension(:), allocatable :: f
+
+    ! A run interrupted by an exception raised in a callback never gets
+    ! to teardown(), so whatever it left allocated is released first.
+    call teardown()
+
+    nx = size(x)
+    dx = x(2) - x(1)
+
+    allocate(f(nx))
+    call fftfreq(nx, dx, f)
+    f = 2*pi * f
+
+    allocate(d_(nx))
+    d_ = 0.0
+    do i = 1, size(betas)
+       n = i - 1
+       d_ = d_ + 1.0/fac(n) * betas(i) * f**n
+    end do
+    deallocate(f)
+
+    use_u_ = size(u) == nx .and. maxval(abs(u)) > 0
+    use_absrb_ = size(absrb) == nx .and. maxval(abs(absrb)) > 0
+
+    allocate(u_(nx))
+    allocate(absrb_(nx))
+    u_ = 0.0
+    absrb_ = 0.0
+    if (use_u_) then
+       u_ = u
+    end if
+    if (use_absrb_) then
+       absrb_ = absrb
+    end if
+
+    gamma_ = gamma
+    pump_ = pump
+    loss_ = loss
+    bg_ = bg
+    delta_ = 0
+    if (size(betas) > 0) then
+       delta_ = -betas(1)
+    end if
+
+    allocate(s_(nx))
+    call support()
+    pstep_ = 0
+  end subroutine setup
+
+  subroutine support()
+    ! Find the index ranges where the absorber is nonzero. The
+    ! absorbing layers are usually at the edges of the grid, so there
+    ! are only a few of them.
+    logical, dimension(size(absrb_)) :: on
+    integer :: nx, n, i
+
+    nx = size(absrb_)
+    on = absrb_ /= 0
+    n = count(on(2:) .and. .not. on(:nx-1))
+    if (on(1)) then
+       n = n + 1
+    end if
+
+    allocate(ranges_(2, n))
+    n = 0
+    do i = 1, nx
+       if (.not. on(i)) then
+          cycle
+       end if
+       if (i == 1) then
+          n = n + 1
+          ranges_(1, n) = i
+       else if (.not. on(i-1)) then
+          n = n + 1
+          ranges_(1, n) = i
+       end if
+       ranges_(2, n) = i
+    end do
+  end subroutine support
+
+  subroutine teardown()
+    if (allocated(d_)) then
+       deallocate(d_)
+       deallocate(u_)
+       deallocate(absrb_)
+       deallocate(s_)
+       deallocate(ranges_)
+    end if
+    if (allocated(trace_)) then
+       deallocate(trace_)
+       deallocate(probes_)
+    end if
+    pstep_ = 0
+    if (allocated(prev_)) then
+       deallocate(prev_)
+    end if
+    if (allocated(times_)) then
+       deallocate(times_)
+       deallocate(deltas_)
+       deallocate(pumps_)
+       deallocate(losses_)
+    end if
+    if (allocated(e_)) then
+       deallocate(e_)
+       deallocate(ef_)
+       deallocate(l_)
+    end if
+    if (allocated(es_)) then
+       deallocate(es_)
+       deallocate(efs_)
+       deallocate(ls_)
+       deallocate(ss_)
+    end if
+    single_ = .FALSE.
+  end subroutine teardown
+
+  subroutine dispersive_step(y, e)
+    ! Multiply the spectrum of y by the propagator e.
+    double complex, dimension(:) :: y, e
+    integer :: i
+    call fft(y, s_)
+    !$omp parallel do
+    do i = 1, size(s_)
+       s_(i) = e(i) * s_(i)
+    end do
+    !$omp end parallel do
+    call ifft(s_, y)
+  end subroutine dispersive_step
+
+  subroutine dispersive_steps(y, s, e, p)
+    ! dispersive_step() for the members of an ensemble, the columns of
+    ! y, with s as the spectra buffer. All the members are transformed
+    ! by one batched plan. They only differ in the detuning, which is
+    ! the constant term of the dispersion operator, so the propagator
+    ! of member b is the common one e times the phase p(b). The phases
+    ! also carry the normalization of the backward transforms.
+    double complex, dimension(:, :) :: y, s
+    double complex, dimension(:) :: e, p
+    double complex :: q
+    integer :: i, b
+    call fft_many(y, s)
+    do b = 1, size(s, 2)
+       q = p(b)
+       !$omp parallel do
+       do i = 1, size(s, 1)
+          s(i, b) = q * e(i) * s(i, b)
+       end do
+       !$omp end parallel do
+    end do
+    call ifft_many(s, y)
+  end subroutine dispersive_steps
+
+  subroutine linear_factor(h, l)
+    ! Combined factor of the potential and the losses over a step h.
+    double precision :: h
+    double complex, dimension(:) :: l
+    l = exp(-(im * u_ + loss_) * h)
+  end subroutine linear_factor
+
+  subroutine kick(y, h, l, first, last, absorbing)
+    ! Nonlinearity, losses and pump, and if absorbing also the
+    ! absorber, over a step h for the points first to last of y. This
+    ! is one fused point-wise pass, so it is also split between the
+    ! OpenMP threads.
+    double complex, dimension(:) :: y, l
+    double precision :: h
+    integer :: first, last
+    logical :: absorbing
+    double precision :: a, phase
+    double complex :: z
+    integer :: i
+    if (absorbing) then
+       !$omp parallel do private(a, phase, z)
+       do i = first, last
+          a = abs(y(i))
+          phase = gamma_ * a * a * h
+          z = l(i) * y(i) * cmplx(cos(phase), sin(phase), kind=8)
+          y(i) = exp(-absrb_(i) * (a - bg_) * h) * z + im * pump_ * h
+       end do
+       !$omp end parallel do
+    else
+       !$omp parallel do private(a, phase)
+       do i = first, last
+          a = abs(y(i))
+          phase = gamma_ * a * a * h
+          y(i) = l(i) * y(i) * cmplx(cos(phase), sin(phase), kind=8) &
+               + im * pump_ * h
+       end do
+       !$omp end parallel do
+    end if
+  end subroutine kick
+
+  subroutine nonlinear_step(y, h, l)
+    ! Nonlinearity, absorption, losses and pump over a step h, l being
+    ! the linear factor for the same step. The absorber is only
+    ! evaluated within its support.
+    double complex, dimension(:) :: y, l
+    double precision :: h
+    integer :: first, k
+    first = 1
+    do k = 1, size(ranges_, 2)
+       call kick(y, h, l, first, ranges_(1, k) - 1, .FALSE.)
+       call kick(y, h, l, ranges_(1, k), ranges_(2, k), .TRUE.)
+       first = ranges_(2, k) + 1
+    end do
+    call kick(y, h, l, first, size(y), .FALSE.)
+  end subroutine nonlinear_step
+
+  subroutine dispersive_step_single(y, e)
+    ! dispersive_step() in single precision.
+    complex, dimension(:) :: y, e
+    integer :: i
+    call fft_single(y, ss_)
+    !$omp parallel do
+    do i = 1, size(ss_)
+       ss_(i) = e(i) * ss_(i)
+    end do
+    !$omp end parallel do
+    call ifft_single(ss_, y)
+  end subroutine dispersive_step_single
+
+  subroutine kick_single(y, h, l, first, last, absorbing)
+    ! kick() in single precision. The squared amplitude is summed up
+    ! directly instead of going through abs(), which calls hypotf and
+    ! keeps the loop from being vectorized.
+    complex, dimension(:) :: y, l
+    double precision :: h
+    integer :: first, last
+    logical :: absorbing
+    real :: a2, phase, g, b, bg
+    complex :: p, z
+    integer :: i
+    g = real(gamma_ * h)
+    p = cmplx(0.0, pump_ * h)
+    bg = real(bg_)
+    if (absorbing) then
+       !$omp parallel do private(a2, phase, z, b)
+       do i = first, last
+          a2 = real(y(i))**2 + aimag(y(i))**2
+          phase = g * a2
+          b = real(absrb_(i) * h)
+          z = l(i) * y(i) * cmplx(cos(phase), sin(phase))
+          y(i) = exp(-b * (sqrt(a2) - bg)) * z + p
+       end do
+       !$omp end parallel do
+    else
+       !$omp parallel do private(a2, phase)
+       do i = first, last
+          a2 = real(y(i))**2 + aimag(y(i))**2
+          phase = g * a2
+          y(i) = l(i) * y(i) * cmplx(cos(phase), sin(phase)) + p
+       end do
+       !$omp end parallel do
+    end if
+  end subroutine kick_single
+
+  subroutine nonlinear_step_single(y, h, l)
+    ! nonlinear_step() in single precision.
+    complex, dimension(:) :: y, l
+    double precision :: h
+    integer :: first, k
+    first = 1
+    do k = 1, size(ranges_, 2)
+       call kick_single(y, h, l, first, ranges_(1, k) - 1, .FALSE.)
+       call kick_single(y, h, l, ranges_(1, k), ranges_(2, k), .TRUE.)
+       first = ranges_(2, k) + 1
+    end do
+    call kick_single(y, h, l, first, size(y), .FALSE.)
+  end subroutine nonlinear_step_single
+
+  subroutine term(y, first, last, absorbing)
+    ! Right hand side of the local part of the equation, in place, for
+    ! the points first to last of y, and if absorbing also the
+    ! absorber, the counterpart of kick().
+    double complex, dimension(:) :: y
+    integer :: first, last
+    logical :: absorbing
+    double precision :: a
+    double complex :: nl
+    integer :: i
+    !$omp parallel do private(a, nl)
+    do i = first, last
+       a = abs(y(i))
+       nl = gamma_ * a * a
+       if (use_u_) then
+          nl = nl - u_(i)
+       end if
+       if (absorbing) then
+          nl = nl + im * absrb_(i) * (a - bg_)
+       end if
+       y(i) = im * nl * y(i) - loss_ * y(i) + im * pump_
+    end do
+    !$omp end parallel do
+  end subroutine term
+
+  subroutine nonlinear_term(y)
+    ! Right hand side of the local part of the equation, in place. The
+    ! absorber is only evaluated within its support.
+    double complex, dimension(:) :: y
+    integer :: first, k
+    first = 1
+    do k = 1, size(ranges_, 2)
+       call term(y, first, ranges_(1, k) - 1, .FALSE.)
+       call term(y, ranges_(1, k), ranges_(2, k), .TRUE.)
+       first = ranges_(2, k) + 1
+    end do
+    call term(y, first, size(y), .FALSE.)
+  end subroutine nonlinear_term
+
+  subroutine substeps(dt)
+    ! Precompute the dispersive substep propagators and the linear
+    ! factors of the nonlinear substeps of the splitting scheme for
+    ! the step dt.
+    double precision :: dt
+    integer :: j, m
+    m = size(b_)
+    if (allocated(e_)) then
+       deallocate(e_)
+       deallocate(ef_)
+       deallocate(l_)
+    end if
+    allocate(e_(size(d_), 0:m))
+    allocate(ef_(size(d_)))
+    allocate(l_(size(d_), m))
+    do j = 0, m
+       e_(:, j) = exp(im * d_ * a_(j) * dt)
+    end do
+    do j = 1, m
+       call linear_factor(b_(j) * dt, l_(:, j))
+    end do
+    ef_ = exp(im * d_ * (a_(m) + a_(0)) * dt)
+    if (single_) then
+       if (allocated(es_)) then
+          deallocate(es_)
+          deallocate(efs_)
+          deallocate(ls_)
+          deallocate(ss_)
+       end if
+       allocate(es_(size(d_), 0:m))
+       allocate(efs_(size(d_)))
+       allocate(ls_(size(d_), m))
+       allocate(ss_(size(d_)))
+       es_ = e_
+       efs_ = ef_
+       ls_ = l_
+    end if
+  end subroutine substeps
+
+  subroutine advance(y, t0, t1, dt, steps, fused)
+    ! Advance y with the splitting scheme from the time t0 + steps*dt
+    ! to the step nearest to t1, updating the step counter. Steps are
+    ! taken for as long as t1 is more than half a step away. The
+    ! probed steps are closed, so that the probes see the whole step.
+    double complex, dimension(:) :: y
+    double precision :: t0, t1, dt
+    integer*8 :: steps
+    logical :: fused
+
+    integer :: j, m
+    double precision :: t_
+    logical :: opened, probed
+
+    m = size(b_)
+    t_ = t0 + steps * dt
+    opened = .FALSE.
+    do while (t_ < t1 - dt/2)
+       ! Opening dispersive substep. In the fused mode it is only
+       ! done at the beginning of the run and after every snapshot,
+       ! otherwise it is merged into the closing substep of the
+       ! previous iteration.
+       if (.not. opened) then
+          call dispersive_step(y, e_(:, 0))
+          opened = fused
+       end if
+
+       ! Nonlinearity and absorption, interleaved with the inner
+       ! dispersive substeps.
+       do j = 1, m
+          call nonlinear_step(y, b_(j) * dt, l_(:, j))
+          if (j < m) then
+             call dispersive_step(y, e_(:, j))
+          end if
+       end do
+       steps = steps + 1
+       t_ = t0 + steps * dt
+
+       ! Closing dispersive substep, or the two adjacent substeps
+       ! merged into one if neither a snapshot nor a probe is due.
+       probed = pstep_ > 0
+       if (probed) then
+          probed = mod(steps, int(pstep_, 8)) == 0
+       end if
+       if (opened .and. t_ < t1 - dt/2 .and. .not. probed) then
+          call dispersive_step(y, ef_)
+       else
+          call dispersive_step(y, e_(:, m))
+          opened = .FALSE.
+       end if
+       call probe(y, steps)
+    end do
+  end subroutine advance
+
+  subroutine advance_single(y, t0, t1, dt, steps, fused)
+    ! advance() in single precision. The probes are not supported.
+    complex, dimension(:) :: y
+    double precision :: t0, t1, dt
+    integer*8 :: steps
+    logical :: fused
+
+    integer :: j, m
+    double precision :: t_
+    logical :: opened
+
+    m = size(b_)
+    t_ = t0 + steps * dt
+    opened = .FALSE.
+    do while (t_ < t1 - dt/2)
+       if (.not. opened) then
+          call dispersive_step_single(y, es_(:, 0))
+          opened = fused
+       end if
+
+       do j = 1, m
+          call nonlinear_step_single(y, b_(j) * dt, ls_(:, j))
+          if (j < m) then
+             call dispersive_step_single(y, es_(:, j))
+          end if
+       end do
+       steps = steps + 1
+       t_ = t0 + steps * dt
+
+       if (opened .and. t_ < t1 - dt/2) then
+          call dispersive_step_single(y, efs_)
+       else
+          call dispersive_step_single(y, es_(:, m))
+          opened = .FALSE.
+       end if
+    end do
+  end subroutine advance_single
+
+  subroutine advance_ensemble(y, s, t0, t1, dt, steps, fused, &
+       pumps, l, p, pf)
+    ! advance() for the members of an ensemble, the columns of y. The
+    ! pump and the linear factors l(:, j, b) are those of member b, the
+    ! detuning phases p(b, j) and pf(b) go with the propagators e_(:,
+    ! j) and ef_. The probes are not supported.
+    double complex, dimension(:, :) :: y, s
+    double precision :: t0, t1, dt
+    integer*8 :: steps
+    logical :: fused
+    double precision, dimension(:) :: pumps
+    double complex, dimension(:, :, :) :: l
+    double complex, dimension(:, 0:) :: p
+    double complex, dimension(:) :: pf
+
+    integer :: j, m, b
+    double precision :: t_
+    logical :: opened
+
+    m = size(b_)
+    t_ = t0 + steps * dt
+    opened = .FALSE.
+    do while (t_ < t1 - dt/2)
+       if (.not. opened) then
+          call dispersive_steps(y, s, e_(:, 0), p(:, 0))
+          opened = fused
+       end if
+
+       do j = 1, m
+          do b = 1, size(y, 2)
+             pump_ = pumps(b)
+             call nonlinear_step(y(:, b), b_(j) * dt, l(:, j, b))
+          end do
+          if (j < m) then
+             call dispersive_steps(y, s, e_(:, j), p(:, j))
+          end if
+       end do
+       steps = steps + 1
+       t_ = t0 + steps * dt
+
+       if (opened .and. t_ < t1 - dt/2) then
+          call dispersive_steps(y, s, ef_, pf)
+       else
+          call dispersive_steps(y, s, e_(:, m), p(:, m))
+          opened = .FALSE.
+       end if
+    end do
+  end subroutine advance_ensemble
+
   subroutine integrate( &
        t, x, y0, dt,    & ! Grids, initial condition and step
        betas,           & ! Diffraction (dispersion) operator
@@ -108,7 +1231,22 @@ contains
        u,               & ! External potential
        pump, loss,      & ! Pump and loss
        absrb, bg,       & ! Absorbing boundary layer
-       ys)                ! Output matrix
+       ys,              & ! Output matrix
+       fused,           & ! Merge adjacent dispersive half-steps
+       order,           & ! Order of the splitting scheme
+       optimized,       & ! Use the optimized high-order scheme
+       xstart, xstop,   & ! Recorded window
+       xstep, tstep,    & ! Recorded stride in x and t
+       tol, patience,   & ! Steady state detection
+       times, deltas,   & ! Parameter schedules against
+       pumps, losses,   & ! time and the number of their
+       nschedule)         ! points
+    ! Fixed step split-step integration. If nschedule > 0, the
+    ! parameters follow the schedules given by the first nschedule
+    ! points of times, deltas, pumps and losses (see schedule()). With
+    ! tol > 0 the integration stops early once the state has settled
+    ! (see settle()), the index of the last computed snapshot is then
+    ! left in converged and the rest of ys is undefined.
     double precision, dimension(:), intent(in) :: t, x
     double complex, dimension(:), intent(in) :: y0
     double precision, intent(in) :: dt
@@ -116,88 +1254,979 @@ contains
     double precision, dimension(:), intent(in) :: betas, u, absrb
     double precision, intent(in) :: gamma, pump, loss, bg
 
-    double complex, dimension(size(t), size(x)), intent(out) :: ys
+    double complex, dimension( &
+         (size(t) - 1)/tstep + 1, &
+         (xstop - xstart - 1)/xstep + 1), intent(out) :: ys
+    !f2py intent(c) :: ys
 
-    integer :: nt, nx, i, n
-    double precision :: dx, t_
-    double precision, dimension(:), allocatable :: f, d
-    double complex, dimension(:), allocatable :: y, s, e, nl
-    logical :: use_absrb = .FALSE., use_u = .FALSE.
+    logical, intent(in) :: fused
+    !f2py logical, optional, intent(in) :: fused = 1
+    integer, intent(in) :: order
+    !f2py integer, optional, intent(in) :: order = 2
+    !f2py check(order == 2 || order == 4 || order == 6) :: order
+    logical, intent(in) :: optimized
+    !f2py logical, optional, intent(in) :: optimized = 1
+    integer, intent(in) :: xstart, xstop, xstep, tstep
+    !f2py integer, optional, intent(in) :: xstart = 0
+    !f2py integer, optional, intent(in) :: xstop = len(x)
+    !f2py integer, optional, intent(in) :: xstep = 1
+    !f2py integer, optional, intent(in) :: tstep = 1
+    !f2py check(0 <= xstart && xstart < xstop && xstop <= len(x)) :: xstop
+    !f2py check(xstep > 0) :: xstep
+    !f2py check(tstep > 0) :: tstep
+    double precision, intent(in) :: tol
+    !f2py double precision, optional, intent(in) :: tol = 0
+    integer, intent(in) :: patience
+    !f2py integer, optional, intent(in) :: patience = 8
+    !f2py check(patience > 0) :: patience
+    integer, intent(in) :: nschedule
+    !f2py integer, optional, intent(in) :: nschedule = 0
+    !f2py check(nschedule >= 0) :: nschedule
+    double precision, dimension(max(nschedule, 1)), intent(in) :: &
+         times, deltas, pumps, losses
+    !f2py double precision, optional, depend(nschedule) :: times = 0
+    !f2py double precision, optional, depend(nschedule) :: deltas = 0
+    !f2py double precision, optional, depend(nschedule) :: pumps = 0
+    !f2py double precision, optional, depend(nschedule) :: losses = 0
+
+    integer :: nt, nx, i
+    integer*8 :: steps
+    double complex, dimension(:), allocatable :: y
+    logical :: done
     real :: start, stop
 
     nt = size(t)
     nx = size(x)
-    dx = x(2) - x(1)
-    t_ = t(1)
+    steps = 0
 
-    allocate(f(nx))
-    call fftfreq(nx, dx, f)
-    f = 2*pi * f
+    call setup(x, betas, gamma, u, pump, loss, absrb, bg)
+    call schedule(times(1:nschedule), deltas(1:nschedule), &
+         pumps(1:nschedule), losses(1:nschedule))
+    call window(xstart, xstop, xstep, tstep)
+    call splitting(order, optimized)
+    call substeps(dt)
 
-    allocate(d(nx))
-    allocate(e(nx))
-    d = 0.0
-    do i = 1, size(betas)
-       n = i - 1
-       d = d + 1.0/fac(n) * betas(i) * f**n
+    allocate(y(nx))
+    y = y0
+    call snapshot(ys, 1, y0)
+    call settle(y, 1, tol, patience, done)
+    converged = -1
+
+    write (stderr, "(A)") repeat("-", 64)
+    call report_allocated(sizeof(t),   "time grid")
+    call report_allocated(sizeof(x),   "coordinate grid")
+    call report_allocated(sizeof(ys),  "output states matrix")
+    call report_allocated(sizeof(y),   "current state")
+    call report_allocated(sizeof(s_),  "current spectrum")
+    call report_allocated(sizeof(d_),  "diffraction operator")
+    call report_allocated(sizeof(e_),  "substep exponentials")
+    call report_allocated(sizeof(ef_), "merged substep exponential")
+    call report_allocated(sizeof(l_),  "substep linear factors")
+    write (stderr, "(A)") repeat("=", 64)
+    call report_total_allocated()
+
+    call cpu_time(start)
+    write (stderr, *)
+    write (stderr, "(A)") repeat("-", 64)
+    do i = 1, nt-1
+       call update((t(i) + t(i+1))/2, dt)
+       call advance(y, t(1), t(i+1), dt, steps, fused)
+       call snapshot(ys, i+1, y)
+       write (stderr, "(A15 F10.2 '%')") "Integrating:", 100.0 * (real(i)/nt)
+       call settle(y, i+1, tol, patience, done)
+       if (done) then
+          converged = i
+          write (stderr, "(A15 F10.2)") "Converged at:", t(i+1)
+          exit
+       end if
     end do
-    e = exp(im * d * dt/2)
+    call cpu_time(stop)
+    write (stderr, "(A)") repeat("=", 64)
+    write (stderr, "(A15 F8.2 ' seconds')") "Elapsed:", (stop - start)
+    write (stderr, *)
 
-    if ((size(u)) == nx .and. maxval(abs(u)) > 0) then
-       use_u = .TRUE.
-    end if
+    deallocate(y)
+    call teardown()
+  end subroutine integrate
 
-    if (size(absrb) == nx .and. maxval(abs(absrb)) > 0) then
-       use_absrb = .TRUE.
-    end if
+  subroutine integrate_stream( &
+       t, x, y0, dt,           & ! Grids, initial condition and step
+       betas,                  & ! Diffraction (dispersion) operator
+       gamma,                  & ! Nonlinearity coefficient
+       u,                      & ! External potential
+       pump, loss,             & ! Pump and loss
+       absrb, bg,              & ! Absorbing boundary layer
+       callback,               & ! Snapshot consumer
+       fused,                  & ! Merge adjacent dispersive half-steps
+       order,                  & ! Order of the splitting scheme
+       optimized,              & ! Use the optimized high-order scheme
+       xstart, xstop,          & ! Recorded window
+       xstep, tstep,           & ! Recorded stride in x and t
+       tol, patience,          & ! Steady state detection
+       times, deltas,          & ! Parameter schedules against
+       pumps, losses,          & ! time and the number of their
+       nschedule)                ! points
+    ! Same as integrate(), but instead of collecting the snapshots in
+    ! a matrix every one of them is handed to callback(i, y) as soon
+    ! as it is computed, i being the zero-based index of the recorded
+    ! snapshot. Memory use does not depend on the number of snapshots.
+    double precision, dimension(:), intent(in) :: t, x
+    double complex, dimension(:), intent(in) :: y0
+    double precision, intent(in) :: dt
+
+    double precision, dimension(:), intent(in) :: betas, u, absrb
+    double precision, intent(in) :: gamma, pump, loss, bg
+
+    external :: callback
+    !f2py integer :: j, n
+    !f2py double complex, dimension(n) :: z
+    !f2py call callback(j, n, z)
+
+    logical, intent(in) :: fused
+    !f2py logical, optional, intent(in) :: fused = 1
+    integer, intent(in) :: order
+    !f2py integer, optional, intent(in) :: order = 2
+    !f2py check(order == 2 || order == 4 || order == 6) :: order
+    logical, intent(in) :: optimized
+    !f2py logical, optional, intent(in) :: optimized = 1
+    integer, intent(in) :: xstart, xstop, xstep, tstep
+    !f2py integer, optional, intent(in) :: xstart = 0
+    !f2py integer, optional, intent(in) :: xstop = len(x)
+    !f2py integer, optional, intent(in) :: xstep = 1
+    !f2py integer, optional, intent(in) :: tstep = 1
+    !f2py check(0 <= xstart && xstart < xstop && xstop <= len(x)) :: xstop
+    !f2py check(xstep > 0) :: xstep
+    !f2py check(tstep > 0) :: tstep
+    double precision, intent(in) :: tol
+    !f2py double precision, optional, intent(in) :: tol = 0
+    integer, intent(in) :: patience
+    !f2py integer, optional, intent(in) :: patience = 8
+    !f2py check(patience > 0) :: patience
+    integer, intent(in) :: nschedule
+    !f2py integer, optional, intent(in) :: nschedule = 0
+    !f2py check(nschedule >= 0) :: nschedule
+    double precision, dimension(max(nschedule, 1)), intent(in) :: &
+         times, deltas, pumps, losses
+    !f2py double precision, optional, depend(nschedule) :: times = 0
+    !f2py double precision, optional, depend(nschedule) :: deltas = 0
+    !f2py double precision, optional, depend(nschedule) :: pumps = 0
+    !f2py double precision, optional, depend(nschedule) :: losses = 0
+
+    integer :: nt, nx, i
+    integer*8 :: steps
+    double complex, dimension(:), allocatable :: y
+    logical :: done
+    real :: start, stop
+
+    nt = size(t)
+    nx = size(x)
+    steps = 0
+
+    call setup(x, betas, gamma, u, pump, loss, absrb, bg)
+    call schedule(times(1:nschedule), deltas(1:nschedule), &
+         pumps(1:nschedule), losses(1:nschedule))
+    call window(xstart, xstop, xstep, tstep)
+    call splitting(order, optimized)
+    call substeps(dt)
 
     allocate(y(nx))
-    allocate(s(nx))
-    allocate(nl(nx))
     y = y0
-    ys(1, :) = y0
+    call callback(0, nw_, y(xfirst_:xlast_:xstep_))
+    call settle(y, 1, tol, patience, done)
+    converged = -1
 
+    call cpu_time(start)
     write (stderr, "(A)") repeat("-", 64)
-    call report_allocated(sizeof(t),  "time grid")
-    call report_allocated(sizeof(x),  "coordinate grid")
-    call report_allocated(sizeof(f),  "frequency grid")
-    call report_allocated(sizeof(ys), "output states matrix")
-    call report_allocated(sizeof(y),  "current state")
-    call report_allocated(sizeof(s),  "current spectrum")
-    call report_allocated(sizeof(d),  "diffraction operator")
-    call report_allocated(sizeof(e),  "auxiliary exponential")
-    call report_allocated(sizeof(nl), "nonlinear term")
+    do i = 1, nt-1
+       call update((t(i) + t(i+1))/2, dt)
+       call advance(y, t(1), t(i+1), dt, steps, fused)
+       if (recorded(i+1)) then
+          call callback(i/tstep_, nw_, y(xfirst_:xlast_:xstep_))
+       end if
+       write (stderr, "(A15 F10.2 '%')") "Integrating:", 100.0 * (real(i)/nt)
+       call settle(y, i+1, tol, patience, done)
+       if (done) then
+          converged = i
+          write (stderr, "(A15 F10.2)") "Converged at:", t(i+1)
+          exit
+       end if
+    end do
+    call cpu_time(stop)
+    write (stderr, "(A)") repeat("=", 64)
+    write (stderr, "(A15 F8.2 ' seconds')") "Elapsed:", (stop - start)
+    write (stderr, *)
+
+    deallocate(y)
+    call teardown()
+  end subroutine integrate_stream
+
+  subroutine integrate_single( &
+       t, x, y0, dt,           & ! Grids, initial condition and step
+       betas,                  & ! Diffraction (dispersion) operator
+       gamma,                  & ! Nonlinearity coefficient
+       u,                      & ! External potential
+       pump, loss,             & ! Pump and loss
+       absrb, bg,              & ! Absorbing boundary layer
+       ys,                     & ! Output matrix
+       fused,                  & ! Merge adjacent dispersive half-steps
+       order,                  & ! Order of the splitting scheme
+       optimized,              & ! Use the optimized high-order scheme
+       xstart, xstop,          & ! Recorded window
+       xstep, tstep,           & ! Recorded stride in x and t
+       tol, patience,          & ! Steady state detection
+       times, deltas,          & ! Parameter schedules against
+       pumps, losses,          & ! time and the number of their
+       nschedule)                ! points
+    ! Same as integrate(), but the state is advanced in single
+    ! precision with the sfftw plans, which halves the memory traffic
+    ! of the transforms, and the snapshots are single precision too.
+    ! The propagators are computed in double precision and rounded.
+    double precision, dimension(:), intent(in) :: t, x
+    double complex, dimension(:), intent(in) :: y0
+    double precision, intent(in) :: dt
+
+    double precision, dimension(:), intent(in) :: betas, u, absrb
+    double precision, intent(in) :: gamma, pump, loss, bg
+
+    complex, dimension( &
+         (size(t) - 1)/tstep + 1, &
+         (xstop - xstart - 1)/xstep + 1), intent(out) :: ys
+    !f2py intent(c) :: ys
+
+    logical, intent(in) :: fused
+    !f2py logical, optional, intent(in) :: fused = 1
+    integer, intent(in) :: order
+    !f2py integer, optional, intent(in) :: order = 2
+    !f2py check(order == 2 || order == 4 || order == 6) :: order
+    logical, intent(in) :: optimized
+    !f2py logical, optional, intent(in) :: optimized = 1
+    integer, intent(in) :: xstart, xstop, xstep, tstep
+    !f2py integer, optional, intent(in) :: xstart = 0
+    !f2py integer, optional, intent(in) :: xstop = len(x)
+    !f2py integer, optional, intent(in) :: xstep = 1
+    !f2py integer, optional, intent(in) :: tstep = 1
+    !f2py check(0 <= xstart && xstart < xstop && xstop <= len(x)) :: xstop
+    !f2py check(xstep > 0) :: xstep
+    !f2py check(tstep > 0) :: tstep
+    double precision, intent(in) :: tol
+    !f2py double precision, optional, intent(in) :: tol = 0
+    integer, intent(in) :: patience
+    !f2py integer, optional, intent(in) :: patience = 8
+    !f2py check(patience > 0) :: patience
+    integer, intent(in) :: nschedule
+    !f2py integer, optional, intent(in) :: nschedule = 0
+    !f2py check(nschedule >= 0) :: nschedule
+    double precision, dimension(max(nschedule, 1)), intent(in) :: &
+         times, deltas, pumps, losses
+    !f2py double precision, optional, depend(nschedule) :: times = 0
+    !f2py double precision, optional, depend(nschedule) :: deltas = 0
+    !f2py double precision, optional, depend(nschedule) :: pumps = 0
+    !f2py double precision, optional, depend(nschedule) :: losses = 0
+
+    integer :: nt, nx, i
+    integer*8 :: steps
+    complex, dimension(:), allocatable :: y
+    logical :: done
+    real :: start, stop
+
+    nt = size(t)
+    nx = size(x)
+    steps = 0
+
+    call setup(x, betas, gamma, u, pump, loss, absrb, bg)
+    call schedule(times(1:nschedule), deltas(1:nschedule), &
+         pumps(1:nschedule), losses(1:nschedule))
+    call window(xstart, xstop, xstep, tstep)
+    call splitting(order, optimized)
+    single_ = .TRUE.
+    call substeps(dt)
+
+    allocate(y(nx))
+    y = y0
+    call snapshot_single(ys, 1, y)
+    call settle(cmplx(y, kind=8), 1, tol, patience, done)
+    converged = -1
+
+    write (stderr, "(A)") repeat("-", 64)
+    call report_allocated(sizeof(t),   "time grid")
+    call report_allocated(sizeof(x),   "coordinate grid")
+    call report_allocated(sizeof(ys),  "output states matrix")
+    call report_allocated(sizeof(y),   "current state")
+    call report_allocated(sizeof(ss_), "current spectrum")
+    call report_allocated(sizeof(d_),  "diffraction operator")
+    call report_allocated(sizeof(es_), "substep exponentials")
+    call report_allocated(sizeof(efs_), "merged substep exponential")
+    call report_allocated(sizeof(ls_), "substep linear factors")
     write (stderr, "(A)") repeat("=", 64)
     call report_total_allocated()
 
     call cpu_time(start)
     write (stderr, *)
     write (stderr, "(A)") repeat("-", 64)
+    do i = 1, nt-1
+       call update((t(i) + t(i+1))/2, dt)
+       call advance_single(y, t(1), t(i+1), dt, steps, fused)
+       call snapshot_single(ys, i+1, y)
+       write (stderr, "(A15 F10.2 '%')") "Integrating:", 100.0 * (real(i)/nt)
+       call settle(cmplx(y, kind=8), i+1, tol, patience, done)
+       if (done) then
+          converged = i
+          write (stderr, "(A15 F10.2)") "Converged at:", t(i+1)
+          exit
+       end if
+    end do
+    call cpu_time(stop)
+    write (stderr, "(A)") repeat("=", 64)
+    write (stderr, "(A15 F8.2 ' seconds')") "Elapsed:", (stop - start)
+    write (stderr, *)
+
+    deallocate(y)
+    call teardown()
+  end subroutine integrate_single
+
+  subroutine integrate_stream_single( &
+       t, x, y0, dt,                  & ! Grids, initial condition and step
+       betas,                         & ! Diffraction (dispersion) operator
+       gamma,                         & ! Nonlinearity coefficient
+       u,                             & ! External potential
+       pump, loss,                    & ! Pump and loss
+       absrb, bg,                     & ! Absorbing boundary layer
+       callback,                      & ! Snapshot consumer
+       fused,                         & ! Merge adjacent dispersive half-steps
+       order,                         & ! Order of the splitting scheme
+       optimized,                     & ! Use the optimized high-order scheme
+       xstart, xstop,                 & ! Recorded window
+       xstep, tstep,                  & ! Recorded stride in x and t
+       tol, patience,                 & ! Steady state detection
+       times, deltas,                 & ! Parameter schedules against
+       pumps, losses,                 & ! time and the number of their
+       nschedule)                       ! points
+    ! integrate_stream() in single precision, see integrate_single().
+    ! The callback gets single precision snapshots.
+    double precision, dimension(:), intent(in) :: t, x
+    double complex, dimension(:), intent(in) :: y0
+    double precision, intent(in) :: dt
+
+    double precision, dimension(:), intent(in) :: betas, u, absrb
+    double precision, intent(in) :: gamma, pump, loss, bg
+
+    external :: callback
+    !f2py integer :: j, n
+    !f2py complex, dimension(n) :: z
+    !f2py call callback(j, n, z)
+
+    logical, intent(in) :: fused
+    !f2py logical, optional, intent(in) :: fused = 1
+    integer, intent(in) :: order
+    !f2py integer, optional, intent(in) :: order = 2
+    !f2py check(order == 2 || order == 4 || order == 6) :: order
+    logical, intent(in) :: optimized
+    !f2py logical, optional, intent(in) :: optimized = 1
+    integer, intent(in) :: xstart, xstop, xstep, tstep
+    !f2py integer, optional, intent(in) :: xstart = 0
+    !f2py integer, optional, intent(in) :: xstop = len(x)
+    !f2py integer, optional, intent(in) :: xstep = 1
+    !f2py integer, optional, intent(in) :: tstep = 1
+    !f2py check(0 <= xstart && xstart < xstop && xstop <= len(x)) :: xstop
+    !f2py check(xstep > 0) :: xstep
+    !f2py check(tstep > 0) :: tstep
+    double precision, intent(in) :: tol
+    !f2py double precision, optional, intent(in) :: tol = 0
+    integer, intent(in) :: patience
+    !f2py integer, optional, intent(in) :: patience = 8
+    !f2py check(patience > 0) :: patience
+    integer, intent(in) :: nschedule
+    !f2py integer, optional, intent(in) :: nschedule = 0
+    !f2py check(nschedule >= 0) :: nschedule
+    double precision, dimension(max(nschedule, 1)), intent(in) :: &
+         times, deltas, pumps, losses
+    !f2py double precision, optional, depend(nschedule) :: times = 0
+    !f2py double precision, optional, depend(nschedule) :: deltas = 0
+    !f2py double precision, optional, depend(nschedule) :: pumps = 0
+    !f2py double precision, optional, depend(nschedule) :: losses = 0
+
+    integer :: nt, nx, i
+    integer*8 :: steps
+    complex, dimension(:), allocatable :: y
+    logical :: done
+    real :: start, stop
+
+    nt = size(t)
+    nx = size(x)
+    steps = 0
+
+    call setup(x, betas, gamma, u, pump, loss, absrb, bg)
+    call schedule(times(1:nschedule), deltas(1:nschedule), &
+         pumps(1:nschedule), losses(1:nschedule))
+    call window(xstart, xstop, xstep, tstep)
+    call splitting(order, optimized)
+    single_ = .TRUE.
+    call substeps(dt)
+
+    allocate(y(nx))
+    y = y0
+    call callback(0, nw_, y(xfirst_:xlast_:xstep_))
+    call settle(cmplx(y, kind=8), 1, tol, patience, done)
+    converged = -1
+
+    call cpu_time(start)
+    write (stderr, "(A)") repeat("-", 64)
+    do i = 1, nt-1
+       call update((t(i) + t(i+1))/2, dt)
+       call advance_single(y, t(1), t(i+1), dt, steps, fused)
+       if (recorded(i+1)) then
+          call callback(i/tstep_, nw_, y(xfirst_:xlast_:xstep_))
+       end if
+       write (stderr, "(A15 F10.2 '%')") "Integrating:", 100.0 * (real(i)/nt)
+       call settle(cmplx(y, kind=8), i+1, tol, patience, done)
+       if (done) then
+          converged = i
+          write (stderr, "(A15 F10.2)") "Converged at:", t(i+1)
+          exit
+       end if
+    end do
+    call cpu_time(stop)
+    write (stderr, "(A)") repeat("=", 64)
+    write (stderr, "(A15 F8.2 ' seconds')") "Elapsed:", (stop - start)
+    write (stderr, *)
+
+    deallocate(y)
+    call teardown()
+  end subroutine integrate_stream_single
+
+  subroutine observe( &
+       t, x, y0, dt,    & ! Grids, initial condition and step
+       betas,           & ! Diffraction (dispersion) operator
+       gamma,           & ! Nonlinearity coefficient
+       u,               & ! External potential
+       pump, loss,      & ! Pump and loss
+       absrb, bg,       & ! Absorbing boundary layer
+       probes, modes,   & ! Probe indices and projection modes
+       moments,         & ! Energy, centre of mass and width
+       fields,          & ! Field at the probe points
+       projections,     & ! Projections on the modes
+       y,               & ! Final state
+       trace,           & ! Field at the probe points at internal steps
+       fused,           & ! Merge adjacent dispersive half-steps
+       order,           & ! Order of the splitting scheme
+       optimized,       & ! Use the optimized high-order scheme
+       pstep, ns,       & ! Probe rate in steps and number of samples
+       times, deltas,   & ! Parameter schedules against
+       pumps, losses,   & ! time and the number of their
+       nschedule)         ! points
+    ! Same integration as integrate(), but instead of the states only
+    ! their observables are recorded at every output time (see
+    ! measure()), together with the final state to continue from.
+    ! probes are zero-based indices in x and modes is an (nx, nm)
+    ! matrix with the modes in its columns, either may be empty. With
+    ! pstep > 0 the field at the probes is also recorded into trace
+    ! after every pstep-th internal step, that is at the times t(1) +
+    ! k*pstep*dt. Those steps are not fused, so that pstep = 1 costs
+    ! the fused mode altogether. ns is the number of the samples,
+    ! which by default covers the whole run.
+    double precision, dimension(:), intent(in) :: t, x
+    double complex, dimension(:), intent(in) :: y0
+    double precision, intent(in) :: dt
+
+    double precision, dimension(:), intent(in) :: betas, u, absrb
+    double precision, intent(in) :: gamma, pump, loss, bg
+
+    integer, dimension(:), intent(in) :: probes
+    double precision, dimension(:, :), intent(in) :: modes
+    !f2py check(shape(modes, 0) == len(x)) :: modes
+
+    double precision, dimension(size(t), 3), intent(out) :: moments
+    !f2py intent(c) :: moments
+    double complex, dimension(size(t), size(probes)), intent(out) :: fields
+    !f2py intent(c) :: fields
+    double complex, dimension(size(t), size(modes, 2)), &
+         intent(out) :: projections
+    !f2py intent(c) :: projections
+    double complex, dimension(size(x)), intent(out) :: y
+    double complex, dimension(ns, size(probes)), intent(out) :: trace
+
+    logical, intent(in) :: fused
+    !f2py logical, optional, intent(in) :: fused = 1
+    integer, intent(in) :: order
+    !f2py integer, optional, intent(in) :: order = 2
+    !f2py check(order == 2 || order == 4 || order == 6) :: order
+    logical, intent(in) :: optimized
+    !f2py logical, optional, intent(in) :: optimized = 1
+    integer, intent(in) :: pstep, ns
+    !f2py integer, optional, intent(in) :: pstep = 0
+    !f2py check(pstep >= 0) :: pstep
+    !f2py integer, optional, intent(in), depend(t, dt, pstep) :: ns = (pstep > 0 ? (int)ceil((t[len(t)-1] - t[0])/dt - 0.5)/pstep + 1 : 0)
+    integer, intent(in) :: nschedule
+    !f2py integer, optional, intent(in) :: nschedule = 0
+    !f2py check(nschedule >= 0) :: nschedule
+    double precision, dimension(max(nschedule, 1)), intent(in) :: &
+         times, deltas, pumps, losses
+    !f2py double precision, optional, depend(nschedule) :: times = 0
+    !f2py double precision, optional, depend(nschedule) :: deltas = 0
+    !f2py double precision, optional, depend(nschedule) :: pumps = 0
+    !f2py double precision, optional, depend(nschedule) :: losses = 0
+
+    integer :: nt, nx, i
+    integer*8 :: steps
+    double precision, dimension(:), allocatable :: w
+    real :: start, stop
+
+    nt = size(t)
+    nx = size(x)
+    steps = 0
+
+    call setup(x, betas, gamma, u, pump, loss, absrb, bg)
+    call schedule(times(1:nschedule), deltas(1:nschedule), &
+         pumps(1:nschedule), losses(1:nschedule))
+    call splitting(order, optimized)
+    call substeps(dt)
+
+    allocate(w(nx))
+    w = x(2) - x(1)
+    w(1) = w(1) / 2
+    w(nx) = w(nx) / 2
+
+    y = y0
+    call measure(y, 1, x, w, probes, modes, moments, fields, projections)
+
+    if (pstep > 0) then
+       allocate(probes_(size(probes)))
+       allocate(trace_(size(probes), ns))
+       probes_ = probes
+       trace_ = 0
+       pstep_ = pstep
+       call probe(y, steps)
+    end if
+
+    call cpu_time(start)
+    write (stderr, "(A)") repeat("-", 64)
+    do i = 1, nt-1
+       call update((t(i) + t(i+1))/2, dt)
+       call advance(y, t(1), t(i+1), dt, steps, fused)
+       call measure(y, i+1, x, w, probes, modes, &
+            moments, fields, projections)
+       write (stderr, "(A15 F10.2 '%')") "Integrating:", 100.0 * (real(i)/nt)
+    end do
+    call cpu_time(stop)
+    write (stderr, "(A)") repeat("=", 64)
+    write (stderr, "(A15 F8.2 ' seconds')") "Elapsed:", (stop - start)
+    write (stderr, *)
+
+    if (pstep > 0) then
+       trace = transpose(trace_)
+    end if
+
+    deallocate(w)
+    call teardown()
+  end subroutine observe
+
+  subroutine ensemble( &
+       t, x, y0, dt,    & ! Grids, initial conditions and step
+       betas,           & ! Diffraction (dispersion) operator
+       gamma,           & ! Nonlinearity coefficient
+       u,               & ! External potential
+       deltas,          & ! Detuning of every member
+       pumps, losses,   & ! Pump and loss of every member
+       absrb, bg,       & ! Absorbing boundary layer
+       ys,              & ! Output states
+       fused,           & ! Merge adjacent dispersive half-steps
+       order,           & ! Order of the splitting scheme
+       optimized,       & ! Use the optimized high-order scheme
+       xstart, xstop,   & ! Recorded window
+       xstep, tstep,    & ! Recorded stride in x and t
+       nb)                ! Number of members
+    ! Fixed step split-step integration of an ensemble of nb
+    ! independent fields, the rows of the (nb, nx) matrix y0, each
+    ! with its own detuning, pump and loss. The detuning of a member
+    ! takes the place of -betas(1). The members are advanced together,
+    ! so that the FFTs of all of them are done by one batched plan and
+    ! the propagators are shared, which amortizes the per-step
+    ! overhead of a parameter scan. ys holds the states of every
+    ! member as it would be returned by integrate().
+    !$ use omp_lib
+    double precision, dimension(:), intent(in) :: t, x
+    double complex, dimension(nb, size(x)), intent(in) :: y0
+    !f2py intent(c) :: y0
+    double precision, intent(in) :: dt
+    double precision, dimension(nb), intent(in) :: deltas, pumps, losses
+
+    double precision, dimension(:), intent(in) :: betas, u, absrb
+    double precision, intent(in) :: gamma, bg
+
+    double complex, dimension( &
+         nb, &
+         (size(t) - 1)/tstep + 1, &
+         (xstop - xstart - 1)/xstep + 1), intent(out) :: ys
+    !f2py intent(c) :: ys
+
+    logical, intent(in) :: fused
+    !f2py logical, optional, intent(in) :: fused = 1
+    integer, intent(in) :: order
+    !f2py integer, optional, intent(in) :: order = 2
+    !f2py check(order == 2 || order == 4 || order == 6) :: order
+    logical, intent(in) :: optimized
+    !f2py logical, optional, intent(in) :: optimized = 1
+    integer, intent(in) :: xstart, xstop, xstep, tstep
+    !f2py integer, optional, intent(in) :: xstart = 0
+    !f2py integer, optional, intent(in) :: xstop = len(x)
+    !f2py integer, optional, intent(in) :: xstep = 1
+    !f2py integer, optional, intent(in) :: tstep = 1
+    !f2py check(0 <= xstart && xstart < xstop && xstop <= len(x)) :: xstop
+    !f2py check(xstep > 0) :: xstep
+    !f2py check(tstep > 0) :: tstep
+    integer, intent(in) :: nb
+    !f2py integer, intent(hide), depend(y0) :: nb = shape(y0, 0)
+
+    integer, parameter :: block = 2**15
+    integer :: nt, nx, nr, m, i, j, b, first, last, width
+    integer*8 :: steps, steps_
+    double complex, dimension(:, :), allocatable :: y, s, p
+    double complex, dimension(:, :, :), allocatable :: l
+    double complex, dimension(:), allocatable :: pf
+    real :: start, stop
+
+    nt = size(t)
+    nx = size(x)
+    nr = (nt - 1)/tstep + 1
+    width = max(1, block / nx)
+    !$ width = width * omp_get_max_threads()
+    steps = 0
+
+    call setup(x, betas, gamma, u, 0.0d0, 0.0d0, absrb, bg)
+    call window(xstart, xstop, xstep, tstep)
+    call splitting(order, optimized)
+    call substeps(dt)
+    m = size(b_)
+
+    ! Detuning phases of the substep propagators, together with the
+    ! normalization of the transforms (see dispersive_steps()), and
+    ! the linear factors of every member.
+    allocate(p(nb, 0:m))
+    allocate(pf(nb))
+    allocate(l(nx, m, nb))
+    do j = 0, m
+       p(:, j) = exp(-im * (deltas - delta_) * a_(j) * dt) / nx
+    end do
+    pf = exp(-im * (deltas - delta_) * (a_(m) + a_(0)) * dt) / nx
+    do b = 1, nb
+       loss_ = losses(b)
+       do j = 1, m
+          call linear_factor(b_(j) * dt, l(:, j, b))
+       end do
+    end do
+
+    ! The rows of the C-ordered y0 are the columns of y.
+    allocate(y(nx, nb))
+    allocate(s(nx, nb))
+    y = reshape(y0, [nx, nb])
+    call snapshots(ys, nr, 1, y)
+
+    write (stderr, "(A)") repeat("-", 64)
+    call report_allocated(sizeof(t),   "time grid")
+    call report_allocated(sizeof(x),   "coordinate grid")
+    call report_allocated(sizeof(ys),  "output states matrices")
+    call report_allocated(sizeof(y),   "current states")
+    call report_allocated(sizeof(s),   "current spectra")
+    call report_allocated(sizeof(d_),  "diffraction operator")
+    call report_allocated(sizeof(e_),  "substep exponentials")
+    call report_allocated(sizeof(ef_), "merged substep exponential")
+    call report_allocated(sizeof(l),   "substep linear factors")
+    write (stderr, "(A)") repeat("=", 64)
+    call report_total_allocated()
+
+    call cpu_time(start)
+    write (stderr, *)
+    write (stderr, "(A)") repeat("-", 64)
+    do i = 1, nt-1
+       ! The members are advanced through the output interval in
+       ! blocks of about block points per thread, which keeps the
+       ! working set of a block in the cache.
+       steps_ = steps
+       do first = 1, nb, width
+          last = min(first + width - 1, nb)
+          steps_ = steps
+          call advance_ensemble(                                    &
+               y(:, first:last), s(:, first:last),                  &
+               t(1), t(i+1), dt, steps_, fused,                     &
+               pumps(first:last), l(:, :, first:last),              &
+               p(first:last, :), pf(first:last))
+       end do
+       steps = steps_
+       call snapshots(ys, nr, i+1, y)
+       write (stderr, "(A15 F10.2 '%')") "Integrating:", 100.0 * (real(i)/nt)
+    end do
+    call cpu_time(stop)
+    write (stderr, "(A)") repeat("=", 64)
+    write (stderr, "(A15 F8.2 ' seconds')") "Elapsed:", (stop - start)
+    write (stderr, *)
+
+    deallocate(y)
+    deallocate(s)
+    deallocate(p)
+    deallocate(pf)
+    deallocate(l)
+    call teardown()
+  end subroutine ensemble
+
+  subroutine integrate_adaptive( &
+       t, x, y0, dt,             & ! Grids, initial condition and step
+       betas,                    & ! Diffraction (dispersion) operator
+       gamma,                    & ! Nonlinearity coefficient
+       u,                        & ! External potential
+       pump, loss,               & ! Pump and loss
+       absrb, bg,                & ! Absorbing boundary layer
+       rtol, atol,               & ! Local error tolerances
+       ys,                       & ! Output matrix
+       accepted, rejected,       & ! Step counters per output interval
+       xstart, xstop,            & ! Recorded window
+       xstep, tstep)               ! Recorded stride in x and t
+    ! Split-step integration with step doubling: every step of size h
+    ! is repeated as two steps of size h/2 and the difference between
+    ! the two results is used as the local error estimate. dt is only
+    ! the initial guess for the step size.
+    double precision, dimension(:), intent(in) :: t, x
+    double complex, dimension(:), intent(in) :: y0
+    double precision, intent(in) :: dt
+
+    double precision, dimension(:), intent(in) :: betas, u, absrb
+    double precision, intent(in) :: gamma, pump, loss, bg
+    double precision, intent(in) :: rtol, atol
+
+    double complex, dimension( &
+         (size(t) - 1)/tstep + 1, &
+         (xstop - xstart - 1)/xstep + 1), intent(out) :: ys
+    !f2py intent(c) :: ys
+    integer, dimension(size(t)), intent(out) :: accepted, rejected
+    integer, intent(in) :: xstart, xstop, xstep, tstep
+    !f2py integer, optional, intent(in) :: xstart = 0
+    !f2py integer, optional, intent(in) :: xstop = len(x)
+    !f2py integer, optional, intent(in) :: xstep = 1
+    !f2py integer, optional, intent(in) :: tstep = 1
+    !f2py check(0 <= xstart && xstart < xstop && xstop <= len(x)) :: xstop
+    !f2py check(xstep > 0) :: xstep
+    !f2py check(tstep > 0) :: tstep
+
+    ! Step size control parameters.
+    double precision, parameter :: safety = 0.9
+    double precision, parameter :: minscale = 0.2
+    double precision, parameter :: maxscale = 4.0
+
+    integer :: nt, nx, i
+    double precision :: t_, h, h_, err
+    double complex, dimension(:), allocatable :: y, y1, y2, eq, eh, lh, lf
+    logical :: last
+    real :: start, stop
+
+    nt = size(t)
+    nx = size(x)
+    t_ = t(1)
+    h = dt
+
+    call setup(x, betas, gamma, u, pump, loss, absrb, bg)
+    call window(xstart, xstop, xstep, tstep)
+
+    allocate(y(nx))
+    allocate(y1(nx))
+    allocate(y2(nx))
+    allocate(eq(nx))
+    allocate(eh(nx))
+    allocate(lh(nx))
+    allocate(lf(nx))
+    y = y0
+    call snapshot(ys, 1, y0)
+    accepted = 0
+    rejected = 0
+
+    call cpu_time(start)
+    write (stderr, "(A)") repeat("-", 64)
+    do i = 1, nt-1
+       do while (t_ < t(i+1))
+          ! Do not overshoot the next output time. The shortened step
+          ! is not remembered, so that the controller does not have
+          ! to grow it back after every snapshot.
+          last = t_ + h >= t(i+1)
+          if (last) then
+             h_ = t(i+1) - t_
+          else
+             h_ = h
+          end if
+
+          eq = exp(im * d_ * h_/4)
+          eh = eq * eq
+          call linear_factor(h_/2, lh)
+          lf = lh * lh
+
+          ! One full step.
+          y1 = y
+          call dispersive_step(y1, eh)
+          call nonlinear_step(y1, h_, lf)
+          call dispersive_step(y1, eh)
+
+          ! Two half-steps with the adjacent dispersive quarter-steps
+          ! merged.
+          y2 = y
+          call dispersive_step(y2, eq)
+          call nonlinear_step(y2, h_/2, lh)
+          call dispersive_step(y2, eh)
+          call nonlinear_step(y2, h_/2, lh)
+          call dispersive_step(y2, eq)
+
+          ! Scaled RMS norm of the difference.
+          err = sqrt(sum( &
+               (abs(y2 - y1) / (atol + rtol * max(abs(y), abs(y2))))**2) &
+               / nx)
+
+          if (err <= 1.0) then
+             ! Strang splitting is symmetric, so Richardson
+             ! extrapolation of the two results gains two orders.
+             y = y2 + (y2 - y1) / 3
+             if (last) then
+                t_ = t(i+1)
+             else
+                t_ = t_ + h_
+             end if
+             accepted(i+1) = accepted(i+1) + 1
+          else
+             rejected(i+1) = rejected(i+1) + 1
+          end if
+
+          ! Local error of the Strang step is O(h**3).
+          if (err > 0) then
+             h_ = h_ * min(maxscale, max(minscale, safety * err**(-1.0/3)))
+          else
+             h_ = h_ * maxscale
+          end if
+          if (.not. last .or. h_ < h) then
+             h = h_
+          end if
+       end do
+       call snapshot(ys, i+1, y)
+       write (stderr, "(A15 F10.2 '%' I10 ' steps' I10 ' rejected')") &
+            "Integrating:", 100.0 * (real(i)/nt), &
+            accepted(i+1), rejected(i+1)
+    end do
+    call cpu_time(stop)
+    write (stderr, "(A)") repeat("=", 64)
+    write (stderr, "(A15 I10)") "Accepted:", sum(accepted)
+    write (stderr, "(A15 I10)") "Rejected:", sum(rejected)
+    write (stderr, "(A15 F8.2 ' seconds')") "Elapsed:", (stop - start)
+    write (stderr, *)
+
+    deallocate(y)
+    deallocate(y1)
+    deallocate(y2)
+    deallocate(eq)
+    deallocate(eh)
+    deallocate(lh)
+    deallocate(lf)
+    call teardown()
+  end subroutine integrate_adaptive
+
+  subroutine integrate_rk4ip( &
+       t, x, y0, dt,          & ! Grids, initial condition and step
+       betas,                 & ! Diffraction (dispersion) operator
+       gamma,                 & ! Nonlinearity coefficient
+       u,                     & ! External potential
+       pump, loss,            & ! Pump and loss
+       absrb, bg,             & ! Absorbing boundary layer
+       ys,                    & ! Output matrix
+       xstart, xstop,         & ! Recorded window
+       xstep, tstep)            ! Recorded stride in x and t
+    ! Fourth-order Runge-Kutta in the interaction picture. The state
+    ! is kept as a spectrum between the steps, every step costs four
+    ! evaluations of the nonlinear term (eight FFTs) and reuses the
+    ! precomputed half-step dispersion exponential. The last step
+    ! before every snapshot is shortened to land on the output time.
+    double precision, dimension(:), intent(in) :: t, x
+    double complex, dimension(:), intent(in) :: y0
+    double precision, intent(in) :: dt
+
+    double precision, dimension(:), intent(in) :: betas, u, absrb
+    double precision, intent(in) :: gamma, pump, loss, bg
+
+    double complex, dimension( &
+         (size(t) - 1)/tstep + 1, &
+         (xstop - xstart - 1)/xstep + 1), intent(out) :: ys
+    !f2py intent(c) :: ys
+    integer, intent(in) :: xstart, xstop, xstep, tstep
+    !f2py integer, optional, intent(in) :: xstart = 0
+    !f2py integer, optional, intent(in) :: xstop = len(x)
+    !f2py integer, optional, intent(in) :: xstep = 1
+    !f2py integer, optional, intent(in) :: tstep = 1
+    !f2py check(0 <= xstart && xstart < xstop && xstop <= len(x)) :: xstop
+    !f2py check(xstep > 0) :: xstep
+    !f2py check(tstep > 0) :: tstep
+
+    integer :: nt, nx, i
+    double precision :: t_, h
+    double complex, dimension(:), allocatable :: a, ai, acc, k, w, e, e_
+    real :: start, stop
+
+    nt = size(t)
+    nx = size(x)
+    t_ = t(1)
+
+    call setup(x, betas, gamma, u, pump, loss, absrb, bg)
+    call window(xstart, xstop, xstep, tstep)
+
+    allocate(a(nx))
+    allocate(ai(nx))
+    allocate(acc(nx))
+    allocate(k(nx))
+    allocate(w(nx))
+    allocate(e(nx))
+    allocate(e_(nx))
+    e = exp(im * d_ * dt/2)
+
+    w = y0
+    call fft(w, a)
+    call snapshot(ys, 1, y0)
+
+    call cpu_time(start)
+    write (stderr, "(A)") repeat("-", 64)
     do i = 1, nt-1
        do while (t_ < t(i+1))
-          ! Dispersive half-step.
-          call fft(y, s)
-          s = e * s
-          call ifft(s, y)
-
-          ! Nonlinearity and absorption.
-          nl = gamma * abs(y)**2
-          if (use_u) then
-             nl = nl - u
+          h = dt
+          e_ = e
+          if (t_ + h >= t(i+1)) then
+             h = t(i+1) - t_
+             if (h /= dt) then
+                e_ = exp(im * d_ * h/2)
+             end if
           end if
-          if (use_absrb) then
-             nl = nl + im * absrb * (abs(y) - bg)
+
+          ! ai is the state propagated to the middle of the step, acc
+          ! accumulates the weighted stages.
+          ai = e_ * a
+          call ifft(a, w)
+          call nonlinear_term(w)
+          call fft(w, k)
+          k = e_ * k
+          acc = ai + h/6 * k
+
+          call ifft(ai + h/2 * k, w)
+          call nonlinear_term(w)
+          call fft(w, k)
+          acc = acc + h/3 * k
+
+          call ifft(ai + h/2 * k, w)
+          call nonlinear_term(w)
+          call fft(w, k)
+          acc = acc + h/3 * k
+
+          call ifft(e_ * (ai + h * k), w)
+          call nonlinear_term(w)
+          call fft(w, k)
+          a = e_ * acc + h/6 * k
+
+          if (h /= dt) then
+             t_ = t(i+1)
+          else
+             t_ = t_ + h
           end if
-          y = exp(im * nl * dt) * y
-          y = exp(-loss * dt) * y + im * pump * dt
-
-          ! Dispersive half-step.
-          call fft(y, s)
-          s = e * s
-          call ifft(s, y)
-          t_ = t_ + dt
        end do
-       ys(i+1, :) = y
+       call ifft(a, w)
+       call snapshot(ys, i+1, w)
        write (stderr, "(A15 F10.2 '%')") "Integrating:", 100.0 * (real(i)/nt)
     end do
     call cpu_time(stop)
@@ -205,11 +2234,13 @@ contains
     write (stderr, "(A15 F8.2 ' seconds')") "Elapsed:", (stop - start)
     write (stderr, *)
 
-    deallocate(f)
-    deallocate(d)
+    deallocate(a)
+    deallocate(ai)
+    deallocate(acc)
+    deallocate(k)
+    deallocate(w)
     deallocate(e)
-    deallocate(y)
-    deallocate(s)
-    deallocate(nl)
-  end subroutine integrate
+    deallocate(e_)
+    call teardown()
+  end subroutine integrate_rk4ip
 end module ccgnlse
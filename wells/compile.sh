@@ -4,6 +4,11 @@ set -e;
 
 f2py --fcompiler=gnu95         \
      -I/usr/include            \
+     -lfftw3_omp               \
      -lfftw3                   \
+     -lfftw3f_omp              \
+     -lfftw3f                  \
+     -lgomp                    \
+     --f90flags='-fopenmp'     \
      --arch='-march=native'    \
      -c _solver.f90 -m _solver;
@@ -1,10 +1,659 @@
+import math
 import scipy as s
+import scipy.fft
 import scipy.fftpack as fft
 import scipy.integrate
 import sys
 
 
-def integrate(t, x, input, potential, delta, pump, loss, absorber):
+def dispersion(x, betas):
+    # Dispersion operator in the FFT frequency order, the same Taylor
+    # expansion as the one used by ccgnlse.
+    nx = len(x)
+    dx = x[1] - x[0]
+
+    k = 2*s.pi * fft.fftfreq(nx, dx)
+    d = s.zeros(nx)
+    for n, beta in enumerate(betas):
+        d += 1/math.factorial(n) * beta * k**n
+    return d
+
+
+def dispersive_step(y, e):
+    # Multiply the spectrum of y by the propagator e. The transforms
+    # are done in place, so the returned array shares memory with y.
+    y = fft.fft(y, overwrite_x=True)
+    y *= e
+    return fft.ifft(y, overwrite_x=True)
+
+
+class NonlinearStep:
+    # Local part of the equation: nonlinearity, potential, absorption,
+    # losses and pump. The split-step update is exp(c*h) * y + 1j *
+    # pump * h with c = gain + 1j*phase, the RK4IP right hand side is
+    # c * y + 1j * pump. Real and imaginary parts of c are evaluated
+    # directly into the views of a preallocated buffer, so that a call
+    # does not allocate anything. The buffer has the precision of the
+    # states, dtype being either complex or s.complex64. The absorber
+    # is only evaluated within its support, which is found once. With
+    # batch given, the step is taken for a (batch, nx) matrix of
+    # states at once, pump and loss then being either scalars or
+    # (batch, 1) columns.
+
+    def __init__(self, nx, gamma, u, pump, loss, absrb, bg,
+                 dtype=complex, batch=None):
+        real = s.zeros(0, dtype=dtype).real.dtype
+        u = s.asarray(u, dtype=real)
+        absrb = s.asarray(absrb, dtype=real)
+        self.gamma = gamma
+        self.u = u
+        self.pump = pump
+        self.loss = loss
+        self.use_u = len(u) == nx and abs(u).max() > 0
+        self.use_absrb = len(absrb) == nx and abs(absrb).max() > 0
+
+        # Support of the absorber as a list of slices, together with
+        # the absorber and the background within them.
+        self.ranges = []
+        if self.use_absrb:
+            on = s.concatenate(([False], absrb != 0, [False]))
+            edges = s.flatnonzero(on[1:] != on[:-1])
+            for first, last in zip(edges[::2], edges[1::2]):
+                r = slice(first, last)
+                bg_ = bg[r] if s.ndim(bg) else bg
+                self.ranges.append((r, - absrb[r], bg_))
+
+        shape = nx if batch is None else (batch, nx)
+        self.nl = s.zeros(shape, dtype=dtype)
+        self.a = s.zeros(shape, dtype=real)
+        self.b = s.zeros(shape, dtype=real)
+        self.gain = self.nl.real
+        self.phase = self.nl.imag
+
+        # numpy does not vectorize exp of complex64, but it does the
+        # real exp, cos and sin, so in single precision the exponent
+        # is taken in the polar form.
+        self.polar = self.nl.dtype == s.complex64
+
+    def coefficient(self, y):
+        a, gain, phase = self.a, self.gain, self.phase
+        s.absolute(y, out=a)
+        s.multiply(a, a, out=phase)
+        phase *= self.gamma
+        if self.use_u:
+            phase -= self.u
+        gain[...] = - self.loss
+        for r, absrb, bg in self.ranges:
+            gain_ = gain[..., r]
+            s.subtract(a[..., r], bg, out=gain_)
+            gain_ *= absrb
+            gain_ -= self.loss
+        return self.nl
+
+    def __call__(self, y, h):
+        nl = self.coefficient(y)
+        nl *= h
+        if self.polar:
+            a, b, gain, phase = self.a, self.b, self.gain, self.phase
+            a[...] = s.exp(- self.loss * h)
+            for r, _, _ in self.ranges:
+                s.exp(gain[..., r], out=a[..., r])
+            s.cos(phase, out=b)
+            s.sin(phase, out=phase)
+            phase *= a
+            s.multiply(b, a, out=gain)
+        else:
+            s.exp(nl, out=nl)
+        y *= nl
+        y += 1j * self.pump * h
+        return y
+
+    def term(self, y):
+        y *= self.coefficient(y)
+        y += 1j * self.pump
+        return y
+
+
+class InteractionPictureRHS:
+    # Right hand side of the equation in the interaction picture, as
+    # used with zvode by integrate(). All the work buffers are
+    # allocated once, the nonlinear coefficient is evaluated into the
+    # views of one of them the same way as in NonlinearStep and the
+    # transforms are done in place by scipy.fft with the given number
+    # of workers. The phase factor exp(1j*d*t) and the inverse one,
+    # which is its conjugate and is taken together with the factor
+    # 1j, are only recomputed when t changes.
+
+    def __init__(self, d, potential, pump, loss, absorber, bg, workers=1):
+        nx = len(d)
+        self.d = d
+        self.potential = potential
+        self.pump = pump
+        self.loss = loss
+        self.absorber = absorber
+        self.bg = bg
+        self.workers = workers
+
+        self.t = None
+        self.a = s.zeros(nx)
+        self.forward = s.zeros(nx, dtype=complex)
+        self.backward = s.zeros(nx, dtype=complex)
+        self.state = s.zeros(nx, dtype=complex)
+        self.nl = s.zeros(nx, dtype=complex)
+
+    def phase(self, t):
+        if t == self.t:
+            return
+        self.t = t
+        a = self.a
+        s.multiply(self.d, t, out=a)
+        s.cos(a, out=self.forward.real)
+        s.sin(a, out=self.forward.imag)
+        # 1j * conj(forward).
+        self.backward.real[:] = self.forward.imag
+        self.backward.imag[:] = self.forward.real
+
+    def __call__(self, t, spectrum):
+        self.phase(t)
+        a, nl = self.a, self.nl
+        phase, gain = nl.real, nl.imag
+
+        state = self.state
+        s.multiply(self.forward, spectrum, out=state)
+        state = scipy.fft.ifft(
+            state, overwrite_x=True, workers=self.workers)
+
+        s.absolute(state, out=a)
+        s.multiply(a, a, out=phase)
+        phase -= self.potential
+        s.subtract(a, self.bg, out=gain)
+        gain *= self.absorber
+        gain += self.loss
+        state *= nl
+        state += self.pump
+
+        spectrum = scipy.fft.fft(
+            state, overwrite_x=True, workers=self.workers)
+        spectrum *= self.backward
+        return spectrum
+
+
+def splitting(order=2, optimized=True):
+    # Coefficients of the symmetric splitting scheme of the given
+    # order, the same ones as in ccgnlse. A step is D(a[0]) N(b[0])
+    # D(a[1]) ... N(b[m-1]) D(a[m]), where D and N are the dispersive
+    # and the nonlinear substeps and the coefficients are fractions of
+    # the full step. The higher orders are either Yoshida compositions
+    # of the Strang step or, if optimized, the 6-stage scheme of
+    # Blanes and Moan (4th order) and the 9-stage composition of Kahan
+    # and Li (6th order).
+    if order == 4 and optimized:
+        a = [0.0792036964311957, 0.353172906049774, -0.0420650803577195]
+        a = a + [1 - 2*sum(a)] + a[::-1]
+        b = [0.209515106613362, -0.143851773179818]
+        b = b + [1/2 - sum(b)]
+        b = b + b[::-1]
+        return a, b
+
+    if order == 2:
+        w = [1.0]
+    elif order == 4:
+        w1 = 1 / (2 - 2**(1/3))
+        w = [w1, 1 - 2*w1, w1]
+    elif order == 6 and optimized:
+        w = [0.39216144400731413928, 0.33259913678935943860,
+             -0.70624617255763935981, 0.082213596293550800230]
+        w = w + [1 - 2*sum(w)] + w[::-1]
+    elif order == 6:
+        w = [0.784513610477560, 0.235573213359357, -1.17767998417887]
+        w = w + [1 - 2*sum(w)] + w[::-1]
+    else:
+        raise ValueError("Unsupported splitting order: %s" % order)
+
+    # Symmetric composition of Strang steps with the weights w.
+    a = [w[0]/2] + [(w[j] + w[j+1])/2 for j in range(len(w) - 1)]
+    a = a + [w[-1]/2]
+    return a, w
+
+
+def recorder(nt, nx, xstart=0, xstop=None, xstep=1, tstep=1,
+             callback=None, dtype=complex):
+    # Snapshot recorder shared by the integrators. Only the window
+    # x[xstart:xstop:xstep] of every tstep-th snapshot is kept, the
+    # same as in ccgnlse. Returns the matrix of recorded states and
+    # record(i, y) that stores y as the i-th snapshot if it is kept.
+    # If callback is given, no matrix is allocated and the recorded
+    # windows are passed to callback(j, y) instead, j being the index
+    # of the recorded snapshot. The matrix is of the given dtype, so
+    # the states can be stored in single precision regardless of the
+    # precision they are computed in. The window is taken in the last
+    # axis of y.
+    window = slice(xstart, xstop, xstep)
+    ys = None
+    if callback is None:
+        nw = len(range(nx)[window])
+        ys = s.zeros(((nt - 1)//tstep + 1, nw), dtype=dtype)
+
+        def callback(j, y):
+            ys[j, :] = y
+
+    def record(i, y):
+        if i % tstep == 0:
+            callback(i // tstep, y[..., window])
+
+    return ys, record
+
+
+class SteadyState:
+    # Steady state monitor, the counterpart of settle() in ccgnlse.
+    # Called with the recorded snapshots, it tells when the relative
+    # change of abs(y) between the consecutive ones has stayed below
+    # tol for patience snapshots in a row. converged is then the index
+    # in t of the snapshot the integration stopped at, otherwise -1.
+    # The call with i = 0 resets the monitor.
+
+    def __init__(self, tol, patience=8):
+        self.tol = tol
+        self.patience = patience
+        self.prev = None
+        self.calm = 0
+        self.converged = -1
+
+    def __call__(self, i, y):
+        a = abs(y)
+        if i == 0:
+            self.prev = a
+            self.calm = 0
+            self.converged = -1
+            return False
+
+        change = abs(a - self.prev).max() / max(a.max(), sys.float_info.min)
+        self.prev = a
+        self.calm = self.calm + 1 if change < self.tol else 0
+        if self.calm >= self.patience:
+            self.converged = i
+            return True
+        return False
+
+
+def split_step(t, x, y0, dt, betas, gamma, u, pump, loss, absrb, bg,
+               fused=True, order=2, optimized=True, callback=None,
+               xstart=0, xstop=None, xstep=1, tstep=1,
+               dtype=complex, storage=None, steady=None, observer=None,
+               prober=None, pstep=1, schedule=None):
+    # Split-step integrator. This is a drop-in replacement for
+    # ccgnlse.integrate from the compiled _solver module: it takes the
+    # same arguments and returns the same (nt, nx) matrix of states,
+    # or only the window x[xstart:xstop:xstep] of the states at
+    # t[::tstep] if those are given. If callback is given, the states
+    # are not collected, instead every recorded snapshot is passed to
+    # callback(i, y) as soon as it is computed, the same as in
+    # ccgnlse.integrate_stream. dtype=s.complex64 does the whole
+    # computation in single precision, which halves the memory
+    # traffic of the FFTs; storage is the dtype of the returned
+    # states and defaults to the one of the computation. If steady is
+    # a SteadyState monitor, the integration stops as soon as it says
+    # so and the rows of the states past steady.converged are left
+    # empty. observer(i, y), such as the one from util.observer, is
+    # called with the whole state at every output time regardless of
+    # the recorded window. prober(step, y), such as the one from
+    # util.prober, is called with the whole state after every
+    # pstep-th internal step. Those steps are not fused. schedule is
+    # either None or the tuple (times, deltas, pumps, losses) of
+    # piecewise-linear tables, the same as the ones ccgnlse.integrate
+    # takes: the parameters then follow them, being taken at the
+    # middle of every output interval, and -betas[0], pump and loss
+    # are overridden.
+    nt = len(t)
+    nx = len(x)
+
+    # Dispersive substep propagators are computed only once, the
+    # stepping loop just multiplies by them. ef merges the closing
+    # substep of a step with the opening substep of the next one.
+    a, b = splitting(order, optimized)
+    m = len(b)
+    d = dispersion(x, betas)
+
+    def propagators(d):
+        e = [s.exp(1j * d * a_ * dt).astype(dtype) for a_ in a]
+        ef = s.exp(1j * d * (a[0] + a[-1]) * dt).astype(dtype)
+        return e, ef
+    e, ef = propagators(d)
+    delta = - betas[0] if len(betas) > 0 else 0
+
+    nonlinear_step = NonlinearStep(
+        nx, gamma, u, pump, loss, absrb, bg, dtype)
+
+    y = s.array(y0, dtype=dtype)
+    ys, record = recorder(
+        nt, nx, xstart, xstop, xstep, tstep, callback, storage or dtype)
+    record(0, y)
+    if observer is not None:
+        observer(0, y)
+    if prober is not None:
+        prober(0, y)
+    if steady is not None:
+        steady(0, y)
+
+    t_ = t[0]
+    steps = 0
+    opened = False
+    for i in range(1, nt):
+        sys.stderr.write("\rIntegrating: %-3.3f%%" % (100 * i/nt))
+        if schedule is not None:
+            # The detuning only shifts the dispersion operator, the
+            # propagators are only recomputed if it has changed.
+            times, deltas, pumps, losses = schedule
+            middle = (t[i-1] + t[i])/2
+            delta_ = s.interp(middle, times, deltas)
+            nonlinear_step.pump = s.interp(middle, times, pumps)
+            nonlinear_step.loss = s.interp(middle, times, losses)
+            if delta_ != delta:
+                d -= delta_ - delta
+                delta = delta_
+                e, ef = propagators(d)
+
+        # Step for as long as the output time is more than half a
+        # step away, so that the snapshot is taken at the nearest step.
+        while t_ < t[i] - dt/2:
+            # Opening dispersive substep. In the fused mode it is only
+            # done at the beginning and after every snapshot,
+            # otherwise it is merged into the closing substep of the
+            # previous iteration.
+            if not opened:
+                y = dispersive_step(y, e[0])
+                opened = fused
+
+            # Nonlinearity, absorption and losses, interleaved with
+            # the inner dispersive substeps.
+            for j in range(m):
+                y = nonlinear_step(y, b[j] * dt)
+                if j < m - 1:
+                    y = dispersive_step(y, e[j+1])
+            steps += 1
+            t_ = t[0] + steps * dt
+
+            # Closing dispersive substep, or the two adjacent substeps
+            # merged into one if neither a snapshot nor a probe is due.
+            probed = prober is not None and steps % pstep == 0
+            if opened and t_ < t[i] - dt/2 and not probed:
+                y = dispersive_step(y, ef)
+            else:
+                y = dispersive_step(y, e[m])
+                opened = False
+            if probed:
+                prober(steps, y)
+        record(i, y)
+        if observer is not None:
+            observer(i, y)
+        if steady is not None and i % tstep == 0 and steady(i, y):
+            sys.stderr.write("\rConverged at: %.2f\n" % t[i])
+            break
+    sys.stderr.write("\r")
+
+    return ys
+
+
+def split_step_ensemble(t, x, y0, dt, betas, gamma, u,
+                        deltas, pumps, losses, absrb, bg,
+                        fused=True, order=2, optimized=True,
+                        xstart=0, xstop=None, xstep=1, tstep=1,
+                        dtype=complex, storage=None, workers=1):
+    # Split-step integration of an ensemble of independent fields,
+    # the counterpart of ccgnlse.ensemble: y0 is the (nb, nx) matrix of
+    # the initial states and every member has its own detuning, pump
+    # and loss, the detuning taking the place of -betas[0]. All the
+    # members are advanced together by batched transforms of scipy.fft
+    # with the given number of workers, so the per-step overhead is
+    # paid once per step and not once per member. Returns the (nb,
+    # nt, nx) states, or only their recorded windows.
+    nt = len(t)
+    nx = len(x)
+    nb = len(deltas)
+
+    # The propagators of a member differ from the common ones only in
+    # the constant term of the dispersion operator.
+    a, b = splitting(order, optimized)
+    m = len(b)
+    d = dispersion(x, [0.0] + list(betas[1:]))
+    d = d - s.reshape(deltas, (nb, 1))
+    e = [s.exp(1j * d * a_ * dt).astype(dtype) for a_ in a]
+    ef = s.exp(1j * d * (a[0] + a[-1]) * dt).astype(dtype)
+
+    def dispersive_step(y, e):
+        y = scipy.fft.fft(y, overwrite_x=True, workers=workers)
+        y *= e
+        return scipy.fft.ifft(y, overwrite_x=True, workers=workers)
+
+    nonlinear_step = NonlinearStep(
+        nx, gamma, u,
+        s.reshape(pumps, (nb, 1)), s.reshape(losses, (nb, 1)),
+        absrb, bg, dtype, batch=nb)
+
+    y = s.array(y0, dtype=dtype)
+    nw = len(range(nx)[xstart:xstop:xstep])
+    ys = s.zeros((nb, (nt - 1)//tstep + 1, nw), dtype=storage or dtype)
+
+    def callback(j, y):
+        ys[:, j, :] = y
+    _, record = recorder(
+        nt, nx, xstart, xstop, xstep, tstep, callback)
+    record(0, y)
+
+    t_ = t[0]
+    steps = 0
+    opened = False
+    for i in range(1, nt):
+        sys.stderr.write("\rIntegrating: %-3.3f%%" % (100 * i/nt))
+        while t_ < t[i] - dt/2:
+            if not opened:
+                y = dispersive_step(y, e[0])
+                opened = fused
+            for j in range(m):
+                y = nonlinear_step(y, b[j] * dt)
+                if j < m - 1:
+                    y = dispersive_step(y, e[j+1])
+            steps += 1
+            t_ = t[0] + steps * dt
+            if opened and t_ < t[i] - dt/2:
+                y = dispersive_step(y, ef)
+            else:
+                y = dispersive_step(y, e[m])
+                opened = False
+        record(i, y)
+    sys.stderr.write("\r")
+
+    return ys
+
+
+def split_step_adaptive(t, x, y0, dt, betas, gamma, u, pump, loss,
+                        absrb, bg, rtol, atol,
+                        xstart=0, xstop=None, xstep=1, tstep=1,
+                        dtype=complex, storage=None, observer=None):
+    # Split-step integration with step doubling, the counterpart of
+    # ccgnlse.integrate_adaptive. Every step of size h is repeated as
+    # two steps of size h/2 and the difference between the results is
+    # used as the local error estimate; dt is only the initial guess.
+    # Returns the states and the numbers of accepted and rejected
+    # steps in every output interval.
+    safety = 0.9
+    minscale = 0.2
+    maxscale = 4.0
+
+    nt = len(t)
+    nx = len(x)
+
+    d = dispersion(x, betas)
+    nonlinear_step = NonlinearStep(
+        nx, gamma, u, pump, loss, absrb, bg, dtype)
+
+    y = s.array(y0, dtype=dtype)
+    y1 = s.zeros(nx, dtype=dtype)
+    y2 = s.zeros(nx, dtype=dtype)
+    ys, record = recorder(
+        nt, nx, xstart, xstop, xstep, tstep, dtype=storage or dtype)
+    record(0, y)
+    if observer is not None:
+        observer(0, y)
+    accepted = s.zeros(nt, dtype=int)
+    rejected = s.zeros(nt, dtype=int)
+
+    t_ = t[0]
+    h = dt
+    for i in range(1, nt):
+        sys.stderr.write("\rIntegrating: %-3.3f%%" % (100 * i/nt))
+        while t_ < t[i]:
+            # Do not overshoot the next output time. The shortened
+            # step is not remembered, so that the controller does not
+            # have to grow it back after every snapshot.
+            last = t_ + h >= t[i]
+            h_ = t[i] - t_ if last else h
+
+            eq = s.exp(1j * d * h_/4).astype(dtype)
+            eh = eq * eq
+
+            # One full step.
+            y1[:] = y
+            y1 = dispersive_step(y1, eh)
+            y1 = nonlinear_step(y1, h_)
+            y1 = dispersive_step(y1, eh)
+
+            # Two half-steps with the adjacent dispersive
+            # quarter-steps merged.
+            y2[:] = y
+            y2 = dispersive_step(y2, eq)
+            y2 = nonlinear_step(y2, h_/2)
+            y2 = dispersive_step(y2, eh)
+            y2 = nonlinear_step(y2, h_/2)
+            y2 = dispersive_step(y2, eq)
+
+            # Scaled RMS norm of the difference.
+            scale = atol + rtol * s.maximum(abs(y), abs(y2))
+            err = s.sqrt(s.mean((abs(y2 - y1) / scale)**2))
+
+            if err <= 1:
+                # Strang splitting is symmetric, so Richardson
+                # extrapolation of the two results gains two orders.
+                y = y2 + (y2 - y1) / 3
+                t_ = t[i] if last else t_ + h_
+                accepted[i] += 1
+            else:
+                rejected[i] += 1
+
+            # Local error of the Strang step is O(h**3).
+            if err > 0:
+                h_ = h_ * min(maxscale, max(minscale, safety * err**(-1/3)))
+            else:
+                h_ = h_ * maxscale
+            if not last or h_ < h:
+                h = h_
+        record(i, y)
+        if observer is not None:
+            observer(i, y)
+    sys.stderr.write("\r")
+
+    return ys, accepted, rejected
+
+
+def rk4ip(t, x, y0, dt, betas, gamma, u, pump, loss, absrb, bg,
+          xstart=0, xstop=None, xstep=1, tstep=1,
+          dtype=complex, storage=None, observer=None):
+    # Fourth-order Runge-Kutta in the interaction picture. Takes the
+    # same arguments as split_step. The state is kept as a spectrum
+    # between the steps, every step costs four evaluations of the
+    # nonlinear term, that is eight FFTs, and uses the precomputed
+    # half-step dispersion exponential. The last step before every
+    # snapshot is shortened to land on the output time exactly.
+    nt = len(t)
+    nx = len(x)
+
+    d = dispersion(x, betas)
+    e = s.exp(1j * d * dt/2).astype(dtype)
+    nonlinear_step = NonlinearStep(
+        nx, gamma, u, pump, loss, absrb, bg, dtype)
+
+    def rate(k):
+        # Nonlinear term in the spectral domain, in place.
+        k = fft.ifft(k, overwrite_x=True)
+        k = nonlinear_step.term(k)
+        return fft.fft(k, overwrite_x=True)
+
+    spectrum = fft.fft(s.array(y0, dtype=dtype))
+    spectrum_ = s.zeros(nx, dtype=dtype)
+    acc = s.zeros(nx, dtype=dtype)
+    k = s.zeros(nx, dtype=dtype)
+    ys, record = recorder(
+        nt, nx, xstart, xstop, xstep, tstep, dtype=storage or dtype)
+    record(0, s.asarray(y0))
+    if observer is not None:
+        observer(0, s.asarray(y0))
+
+    t_ = t[0]
+    for i in range(1, nt):
+        sys.stderr.write("\rIntegrating: %-3.3f%%" % (100 * i/nt))
+        while t_ < t[i]:
+            h = dt
+            e_ = e
+            if t_ + h >= t[i]:
+                h = t[i] - t_
+                if h != dt:
+                    e_ = s.exp(1j * d * h/2).astype(dtype)
+
+            # spectrum_ is the state propagated to the middle of the
+            # step, acc accumulates the weighted stages, and k is
+            # rescaled in place so that the next stage input is
+            # spectrum_ + k without temporaries.
+            s.multiply(e_, spectrum, out=spectrum_)
+            k[:] = spectrum
+            k = rate(k)
+            k *= e_
+            s.multiply(k, h/6, out=acc)
+            acc += spectrum_
+
+            k *= h/2
+            k += spectrum_
+            k = rate(k)
+            k *= h/3
+            acc += k
+
+            k *= 3/2
+            k += spectrum_
+            k = rate(k)
+            k *= h/3
+            acc += k
+
+            k *= 3
+            k += spectrum_
+            k *= e_
+            k = rate(k)
+            s.multiply(e_, acc, out=spectrum)
+            k *= h/6
+            spectrum += k
+
+            t_ = t[i] if h != dt else t_ + h
+        if i % tstep == 0 or observer is not None:
+            y = fft.ifft(spectrum)
+            record(i, y)
+            if observer is not None:
+                observer(i, y)
+    sys.stderr.write("\r")
+
+    return ys
+
+
+def integrate(t, x, input, potential, delta, pump, loss, absorber,
+              method="adams", dt=1E-3, dtype=complex, workers=1,
+              observer=None):
+    # Integrate the equation with one of the split-step engines or,
+    # by default, with zvode in the interaction picture. Returns the
+    # shifted wavenumbers, the states and their normalized spectra.
+    # observer(i, y), such as the one from util.observer, is called
+    # with every state.
+    engines = {
+        "split-step": split_step,
+        "rk4ip": rk4ip
+    }
+
     nt = len(t)
     nx = len(x)
 
@@ -13,21 +662,29 @@ def integrate(t, x, input, potential, delta, pump, loss, absorber):
     k = 2*s.pi * fft.fftfreq(nx, dx)
     d = - delta - 1/2 * k**2
 
-    spectrum = fft.fft(input)
-    spectrum_ = spectrum
+    if method in engines:
+        states = engines[method](
+            t, x, input, dt,
+            [-delta, 0.0, -1.0],
+            1.0,
+            potential,
+            pump, loss,
+            absorber, abs(input),
+            dtype=dtype, observer=observer)
+        spectra = 1/nt * fft.fftshift(fft.fft(states), axes=1)
+        k = fft.fftshift(k)
+        return k, states, spectra
 
-    def rhs(t, spectrum_):
-        exp_ = s.exp(1j * d * t)
-        spectrum = exp_ * spectrum_
-        state = fft.ifft(spectrum)
-        nonlinearity = abs(state)**2 * state
-        nonlinearity += - potential * state
-        nonlinearity += 1j * loss * state
-        nonlinearity += 1j * absorber * (abs(state) - abs(input)) * state
-        nonlinearity += pump
+    if method != "adams":
+        raise ValueError("Unknown integration method: %s" % method)
+    if s.dtype(dtype) != s.dtype(complex):
+        raise ValueError("zvode only works in double precision")
 
-        return 1j * 1/exp_ * fft.fft(nonlinearity)
+    spectrum = fft.fft(input)
+    spectrum_ = spectrum
 
+    rhs = InteractionPictureRHS(
+        d, potential, pump, loss, absorber, abs(input), workers)
     solver = scipy.integrate.ode(rhs)
     solver.set_integrator("zvode",
                           rtol=1E-6,
@@ -35,20 +692,32 @@ def integrate(t, x, input, potential, delta, pump, loss, absorber):
                           nsteps=2048)
     solver.set_initial_value(spectrum_, 0)
 
-    spectra_ = s.zeros((nt, nx), dtype=complex)
-    spectra_[0, :] = spectrum_
-    # Preallocate return matrices in advance.
+    # Interaction picture spectra straight from the solver. This
+    # buffer is reused for the output spectra below.
     spectra = s.zeros((nt, nx), dtype=complex)
-    states = s.zeros((nt, nx), dtype=complex)
+    spectra[0, :] = spectrum_
     for i in range(1, nt):
         sys.stderr.write("\rIntegrating: %-3.3f%%" % (100 * i/nt))
-        spectra_[i, :] = solver.integrate(t[i])
+        spectra[i, :] = solver.integrate(t[i])
     sys.stderr.write("\r")
 
-    for i in range(0, nt):
-        spectra[i, :] = s.exp(1j * d * t[i]) * spectra_[i, :]
-        states[i, :] = fft.ifft(spectra[i, :])
-        spectra[i, :] = 1/nt * fft.fftshift(spectra[i, :])
+    # Back from the interaction picture, all rows at once: the phase
+    # factors are the outer product of t and d, exponentiated and
+    # multiplied in place.
+    states = s.multiply.outer(t, 1j * d)
+    s.exp(states, out=states)
+    states *= spectra
+
+    # Normalized and shifted spectra go into the solver buffer, the
+    # shift being done by the two slices instead of fftshift copies.
+    m = nx // 2
+    s.multiply(states[:, :nx-m], 1/nt, out=spectra[:, m:])
+    s.multiply(states[:, nx-m:], 1/nt, out=spectra[:, :m])
+    states = fft.ifft(states, axis=1, overwrite_x=True)
     k = fft.fftshift(k)
 
+    if observer is not None:
+        for i in range(nt):
+            observer(i, states[i, :])
+
     return k, states, spectra
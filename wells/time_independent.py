@@ -1,64 +1,164 @@
+import hashlib
+import os
 import scipy
+import scipy.linalg
 import scipy.optimize as optimize
-import scipy.sparse as sparse
 import scipy.sparse.linalg as linalg
 import wells.util
 
 import sys
 
 
-def finite_difference_linear_problem(x, u, n, which="SM", boundary="box"):
-    nx = len(x)
-    dx = x[1] - x[0]
-
-    if boundary == "box":
-        # In case of infinite-box boundary conditions we need to null
-        # the first and the last column. This will lead for the solver
-        # to find two additional spurious eigenstates with eigenvalues
-        # near zero. Moreover, the first and the last digits of the
-        # eigenvector won't contain any useful information, so we will
-        # need to throw them away. To maintain the length of the
-        # eigenvector we increase the number of elements in the
-        # potential vector by 2 (dummy first and last values).
-        n = n + 2    # spurious eigenstates
-        nx = nx + 2  # extra ticks at beginning and end.
-
-        u_ = scipy.zeros(nx)
-        u_[1:-1] = u
-        u = u_
-
-    laplacian = wells.util.laplacian(nx, dx)
-    potential = sparse.diags(u, 0, (nx, nx))
-    hamiltonian = -1/2 * laplacian + potential
-
-    if boundary == "box":
-        # The only modification to the Hamiltonian is to null the
-        # first and the last column.
-        hamiltonian[:, 0] = 0
-        hamiltonian[:, nx-1] = 0
-
-    if boundary == "periodic":
-        # In case of periodic boundary conditions we need to modify
-        # both rows and columns of the Hamiltonian by inserting -1/dx
-        # at all the zero boundary elements of the matrix.
-        hamiltonian[0, 1:] = -1/dx
-        hamiltonian[1:, 0] = -1/dx
-        hamiltonian[-1, :-1] = -1/dx
-        hamiltonian[:-1, -1] = -1/dx
-
-    eigenvalues, eigenvectors = linalg.eigs(hamiltonian, n, which=which)
+def finite_difference_linear_problem(x, u, n, which="SM", boundary="box",
+                                     sigma=None, first=0, order=2):
+    # n eigenstates of the finite-difference Hamiltonian, starting
+    # from the first-th one, sorted by the absolute value of the
+    # eigenvalue. order is the order of the Laplacian stencil, see
+    # wells.util.laplacian, which also closes it at the boundary: in
+    # case of infinite-box boundary conditions the wave function is
+    # zero outside of the grid, with the periodic ones it wraps
+    # around.
+
+    # For a real potential the Hamiltonian is real symmetric. In the
+    # box with the 3-point stencil it is also tridiagonal, and if the
+    # potential is nowhere negative, so that all the eigenvalues are
+    # positive and their increasing order is that of the magnitude,
+    # the eigenstates with the indices first to first + n - 1 are
+    # found directly by bisection and inverse iteration at O(nx) per
+    # state. Otherwise the eigenstates nearest to sigma (those of the
+    # smallest magnitude if sigma is not given) are found by eigsh in
+    # shift-invert mode, or by eigs for a complex potential, which
+    # converge in a few iterations. The shifted Hamiltonian is solved
+    # as a banded matrix, see wells.util.Hamiltonian; the banded
+    # LAPACK eigensolvers would accumulate dense nx-by-nx
+    # transformations instead. The other choices of which go through
+    # eigs on the Hamiltonian applied matrix-free. The last two
+    # compute all the states up to the last one asked for.
+    if scipy.iscomplexobj(u) and not scipy.any(scipy.imag(u)):
+        u = scipy.real(u)
+    hamiltonian = wells.util.Hamiltonian(x, u, order, boundary)
+    hermitian = scipy.isrealobj(u)
+    tridiagonal = (boundary == "box" and order == 2 and
+                   hermitian and which == "SM" and sigma is None and
+                   u.min() >= 0)
+
+    if tridiagonal:
+        bands = hamiltonian.bands()
+        eigenvalues, eigenvectors = scipy.linalg.eigh_tridiagonal(
+            bands[0], bands[1, :-1],
+            select="i", select_range=(first, first + n - 1))
+    elif which == "SM":
+        sigma = sigma or 0.0
+        solve = linalg.eigsh if hermitian else linalg.eigs
+        eigenvalues, eigenvectors = solve(
+            hamiltonian, first + n, sigma=sigma, which="LM",
+            OPinv=hamiltonian.solver(sigma))
+    else:
+        eigenvalues, eigenvectors = linalg.eigs(
+            hamiltonian, first + n, which=which)
 
     # Sort the eigenstates based on absolute value of the eigenvalue.
-    order = abs(eigenvalues).argsort()
-    eigenvalues = eigenvalues[order]
-    eigenvectors = eigenvectors[:, order]
+    indices = abs(eigenvalues).argsort()
+    eigenvalues = eigenvalues[indices]
+    eigenvectors = eigenvectors[:, indices]
 
-    if boundary == "box":
-        # Throw the spurious states and buffer elements of the vectors.
-        eigenvalues = eigenvalues[2:]
-        eigenvectors = eigenvectors[1:-1, 2:]
+    if not tridiagonal:
+        # Throw away the states before the first one.
+        eigenvalues = eigenvalues[first:]
+        eigenvectors = eigenvectors[:, first:]
 
     return eigenvalues, eigenvectors
 
 
+# On-disk cache of the eigenstates, see cached_fdlp(). The directory
+# can be changed by setting WELLS_CACHE, when the files in it take
+# more than cache_limit bytes the least recently used ones are
+# removed.
+cache_directory = os.environ.get(
+    "WELLS_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "wells"))
+cache_limit = 2**30
+
+
+def cached_finite_difference_linear_problem(x, u, n, which="SM",
+                                            boundary="box", sigma=None,
+                                            first=0, order=2):
+    # Same as finite_difference_linear_problem, but the eigenstates
+    # are kept in the cache directory, keyed by the grid, the
+    # potential and the rest of the arguments except for the number
+    # of states. A request for the states up to first + n is served
+    # from any cached result with at least that many of them,
+    # otherwise those are computed and replace the cached ones. The
+    # arrays are memory-mapped copy-on-write, so they can be modified
+    # in place without touching the files.
+    key = hashlib.sha1()
+    for array in (x, u):
+        array = scipy.ascontiguousarray(array)
+        key.update(str(array.dtype).encode())
+        key.update(array.tobytes())
+    key.update(repr((which, boundary, sigma, order)).encode())
+    stem = os.path.join(cache_directory, key.hexdigest())
+    values = stem + "_values.npy"
+    vectors = stem + "_vectors.npy"
+
+    try:
+        eigenvalues = scipy.load(values, mmap_mode="c")
+        eigenvectors = scipy.load(vectors, mmap_mode="c")
+        if (len(eigenvalues) >= first + n and
+                eigenvectors.shape[1] == len(eigenvalues)):
+            os.utime(values)
+            os.utime(vectors)
+            return (eigenvalues[first:first+n],
+                    eigenvectors[:, first:first+n])
+    except (OSError, ValueError):
+        pass
+
+    eigenvalues, eigenvectors = finite_difference_linear_problem(
+        x, u, first + n, which, boundary, sigma, order=order)
+
+    # The files are written under temporary names and renamed, so that
+    # concurrent runs never see them half-written.
+    os.makedirs(cache_directory, exist_ok=True)
+    for filename, array in ((values, eigenvalues), (vectors, eigenvectors)):
+        temporary = "%s.%d.tmp" % (filename, os.getpid())
+        with open(temporary, "wb") as file:
+            scipy.save(file, array)
+        os.replace(temporary, filename)
+    trim_cache()
+
+    return eigenvalues[first:], eigenvectors[:, first:]
+
+
+def trim_cache():
+    # Remove the least recently used eigenstates from the cache until
+    # it fits into cache_limit. The values and the vectors are removed
+    # together, and files that disappear in the meantime, removed by a
+    # concurrent run, are skipped.
+    entries = {}
+    for name in os.listdir(cache_directory):
+        for suffix in ("_values.npy", "_vectors.npy"):
+            if name.endswith(suffix):
+                path = os.path.join(cache_directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                time, size, paths = entries.get(
+                    name[:-len(suffix)], (0, 0, []))
+                entries[name[:-len(suffix)]] = (
+                    max(time, stat.st_mtime), size + stat.st_size,
+                    paths + [path])
+    entries = sorted(entries.values())
+    total = sum(size for _, size, _ in entries)
+    for _, size, paths in entries:
+        if total <= cache_limit:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+
+
 fdlp = finite_difference_linear_problem
+cached_fdlp = cached_finite_difference_linear_problem
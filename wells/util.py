@@ -1,17 +1,234 @@
+import math
+import numpy.lib.format
 import scipy
 import scipy.fftpack as fft
+import scipy.linalg
 import scipy.sparse as sparse
+import scipy.sparse.linalg
 
 
-def laplacian(n, d=1.0, dtype=None):
+# Central finite-difference stencils of the second derivative by the
+# order of accuracy, the coefficients going from the centre outwards.
+stencils = {
+    2: [-2, 1],
+    4: [-5/2, 4/3, -1/12],
+    6: [-49/18, 3/2, -3/20, 1/90],
+    8: [-205/72, 8/5, -1/5, 8/315, -1/560]
+}
+
+
+def laplacian(n, d=1.0, dtype=None, order=2, boundary="box"):
+    # Finite-difference Laplacian with the central stencil of the
+    # given order. In the box the function is zero outside of the
+    # grid, so the stencil is simply cut at the edges; with the
+    # periodic boundary it wraps around into the corners.
+    if order not in stencils:
+        raise ValueError("Unsupported stencil order: %s" % order)
+    stencil = stencils[order]
+    m = len(stencil)
+    offsets = list(range(1 - m, m))
+    diagonals = [stencil[abs(k)] for k in offsets]
+    if boundary == "periodic":
+        for k in range(1, m):
+            offsets += [k - n, n - k]
+            diagonals += [stencil[k], stencil[k]]
     laplacian = sparse.diags(
-        [1, -2, 1],
-        [-1, 0, +1],
+        diagonals,
+        offsets,
         (n, n),
         dtype=dtype)
     laplacian = 1/d**2 * laplacian
     return laplacian
 
 
+class Hamiltonian(scipy.sparse.linalg.LinearOperator):
+    # Finite-difference Hamiltonian -1/2 d^2/dx^2 + u on the grid x as
+    # a matrix-free operator, with the stencil and the boundary closure
+    # of laplacian(). apply() evaluates (H + shift) y for a diagonal
+    # shift, a scalar or an array, the diagonal and the stencil being
+    # accumulated through a preallocated buffer per dtype, so the
+    # only array allocated is the result, and even that can be passed
+    # in. bands() gives the box Hamiltonian in the lower banded
+    # storage of eigh_tridiagonal and eig_banded, solver() a
+    # LinearOperator applying (H - sigma)^-1 for the shift-invert
+    # modes of eigsh and eigs.
+
+    def __init__(self, x, u, order=2, boundary="box"):
+        if order not in stencils:
+            raise ValueError("Unsupported stencil order: %s" % order)
+        nx = len(x)
+        self.dx = x[1] - x[0]
+        self.u = scipy.asarray(u)
+        self.order = order
+        self.boundary = boundary
+        self.coefficients = -1/2/self.dx**2 * scipy.array(stencils[order])
+        self.diagonal = self.coefficients[0] + self.u
+        self.buffers = {}
+        dtype = scipy.result_type(self.diagonal, float)
+        super().__init__(dtype, (nx, nx))
+
+    def buffer(self, dtype):
+        if dtype not in self.buffers:
+            self.buffers[dtype] = scipy.zeros(self.shape[0], dtype=dtype)
+        return self.buffers[dtype]
+
+    def apply(self, y, shift=None, out=None):
+        nx = self.shape[0]
+        if out is None:
+            shift_ = 0 if shift is None else shift
+            dtype = scipy.result_type(self.dtype, y, shift_)
+            out = scipy.empty(nx, dtype=dtype)
+        buffer = self.buffer(out.dtype)
+        if shift is None:
+            scipy.multiply(self.diagonal, y, out=out)
+        else:
+            scipy.add(self.diagonal, shift, out=buffer)
+            scipy.multiply(buffer, y, out=out)
+        periodic = self.boundary == "periodic"
+        for k, c in enumerate(self.coefficients[1:], 1):
+            b = buffer[:nx-k]
+            scipy.multiply(y[:-k], c, out=b)
+            out[k:] += b
+            scipy.multiply(y[k:], c, out=b)
+            out[:-k] += b
+            if periodic:
+                b = buffer[:k]
+                scipy.multiply(y[-k:], c, out=b)
+                out[:k] += b
+                scipy.multiply(y[:k], c, out=b)
+                out[-k:] += b
+        return out
+
+    def _matvec(self, y):
+        return self.apply(scipy.ravel(y))
+
+    def _rmatvec(self, y):
+        # The stencil is real and symmetric, only the potential needs
+        # to be conjugated.
+        return scipy.conj(self.apply(scipy.conj(scipy.ravel(y))))
+
+    def bands(self, shift=0):
+        # Row k holds the k-th subdiagonal, which with the symmetric
+        # stencil is also the k-th superdiagonal.
+        if self.boundary != "box":
+            raise ValueError("Only the box Hamiltonian is banded")
+        nx = self.shape[0]
+        dtype = scipy.result_type(self.dtype, shift)
+        bands = scipy.empty((len(self.coefficients), nx), dtype=dtype)
+        bands[:] = self.coefficients[:, None]
+        bands[0] = self.diagonal + shift
+        return bands
+
+    def solver(self, sigma=0.0):
+        # The box Hamiltonian is solved as a banded matrix by LAPACK at
+        # O(nx * order**2) per call. The periodic one has the stencil
+        # wrapped into the corners, so it is assembled once as a sparse
+        # matrix and factorized by SuperLU.
+        nx = self.shape[0]
+        dtype = scipy.result_type(self.dtype, sigma)
+        if self.boundary == "box":
+            lower = self.bands(-sigma)
+            m = len(lower) - 1
+            full = scipy.zeros((2*m + 1, nx), dtype=dtype)
+            full[m:] = lower
+            for k in range(1, m + 1):
+                full[m-k, k:] = lower[k, :nx-k]
+
+            def solve(y):
+                return scipy.linalg.solve_banded(
+                    (m, m), full, scipy.ravel(y), check_finite=False)
+        else:
+            matrix = (
+                -1/2 * laplacian(nx, self.dx, dtype, self.order,
+                                 self.boundary) +
+                sparse.diags(self.u - sigma, dtype=dtype))
+            lu = scipy.sparse.linalg.splu(matrix.tocsc())
+
+            def solve(y):
+                y = scipy.ravel(y)
+                if scipy.iscomplexobj(y) and dtype.kind != "c":
+                    return lu.solve(y.real) + 1j * lu.solve(y.imag)
+                return lu.solve(y)
+        return scipy.sparse.linalg.LinearOperator(
+            self.shape, matvec=solve, dtype=dtype)
+
+
 def energy(x, u):
     return scipy.trapz(abs(u)**2, x)
+
+
+def memmap_writer(filename, shape, dtype=complex):
+    # Create a memory-mapped .npy file and a callback that writes the
+    # snapshots produced by a streaming integrator into its rows.
+    states = numpy.lib.format.open_memmap(
+        filename, mode="w+", dtype=dtype, shape=shape)
+
+    def callback(i, y):
+        states[i, :] = y
+
+    return states, callback
+
+
+def observer(t, x, probes=(), modes=None):
+    # Time series of the observables of the states produced by an
+    # integrator, the counterpart of ccgnlse.observe: the energy, the
+    # centre of mass and the width of the field, the field at the
+    # probe indices and the projections on the modes, given as the
+    # columns of an (nx, nm) matrix. Returns the series and a
+    # callback(i, y) that evaluates them for the state at t[i].
+    nt = len(t)
+    nx = len(x)
+    probes = scipy.asarray(probes, dtype=int)
+    if modes is None:
+        modes = scipy.zeros((nx, 0))
+
+    # Trapezoidal quadrature weights, the same as in energy().
+    w = scipy.full(nx, x[1] - x[0])
+    w[0] /= 2
+    w[-1] /= 2
+
+    series = {
+        "energy": scipy.zeros(nt),
+        "center": scipy.zeros(nt),
+        "width": scipy.zeros(nt),
+        "fields": scipy.zeros((nt, len(probes)), dtype=complex),
+        "projections": scipy.zeros((nt, modes.shape[1]), dtype=complex)
+    }
+
+    def callback(i, y):
+        density = abs(y)**2
+        energy = w @ density
+        center = 0
+        width = 0
+        if energy > 0:
+            center = (w * x) @ density / energy
+            width = scipy.sqrt((w * (x - center)**2) @ density / energy)
+        series["energy"][i] = energy
+        series["center"][i] = center
+        series["width"][i] = width
+        series["fields"][i, :] = y[probes]
+        series["projections"][i, :] = (w * y) @ modes
+
+    return series, callback
+
+
+def prober(t, dt, probes, pstep=1):
+    # High-rate probes for a fixed step integrator, the counterpart of
+    # the trace of ccgnlse.observe: the field at the probe indices
+    # after every pstep-th internal step of size dt. Returns the
+    # sample times, the (ns, len(probes)) trace and a callback(step,
+    # y) that records the field after the given number of steps.
+    steps = int(math.ceil((t[-1] - t[0]) / dt - 0.5))
+    ns = steps // pstep + 1
+    probes = scipy.asarray(probes, dtype=int)
+
+    times = t[0] + pstep * dt * scipy.arange(ns)
+    trace = scipy.zeros((ns, len(probes)), dtype=complex)
+
+    def callback(step, y):
+        # Rounding in the stepping loop can add a step beyond the ones
+        # counted here, the same as in ccgnlse.probe.
+        if step // pstep < ns:
+            trace[step // pstep, :] = y[probes]
+
+    return times, trace, callback
@@ -5,7 +5,6 @@ import argparse
 
 import scipy
 import scipy.interpolate as interpolate
-import scipy.sparse as sparse
 import scipy.optimize as optimize
 
 import wells.util as util
@@ -42,14 +41,22 @@ parser.add_argument("--input",
 parser.add_argument("--interpolate",
                     help="Interpolate and oversample initial guess",
                     action="store_true")
+parser.add_argument("--nx",
+                    help="Number of grid points",
+                    type=int,
+                    default=2**14)
+parser.add_argument("--order",
+                    help="Order of the finite-difference Laplacian",
+                    type=int,
+                    choices=[2, 4, 6, 8],
+                    default=2)
 args = parser.parse_args()
 
 
 # Coordinate grid parameters.
 minx = -128
 maxx = +128
-nx = 2**14
-dx = (minx - maxx) / (nx - 1)
+nx = args.nx
 
 # Coordinate grid.
 x = scipy.linspace(minx, maxx, nx)
@@ -61,34 +68,24 @@ u = 1/2 * x**2
 u[abs(x) >= l] = 1/2 * l**2
 
 
-# Define operators for the Newton-CG method.
-laplacian = util.laplacian(nx, dx)
-potential = sparse.diags(u, 0, (nx, nx))
-delta = args.delta * sparse.eye(nx, nx)
-loss = args.loss * sparse.eye(nx, nx)
-pump = args.pump * scipy.ones(2*nx)
-pump[nx:] = 0
-
-laplacian = sparse.bmat([[laplacian, None], [None, laplacian]])
-potential = sparse.bmat([[potential, None], [None, potential]])
-delta = sparse.bmat([[delta, None], [None, delta]])
-loss = sparse.bmat([[None, loss], [-loss, None]])
+# Define operators for the Newton-CG method. The state is split
+# into the real and the imaginary part, which are coupled by the
+# losses.
+hamiltonian = util.Hamiltonian(x, u, order=args.order)
 
 
 # Nonlinear operator.
 def l0(state):
     real = state[:nx]
     imag = state[nx:]
-    power = (real**2 + imag**2)
-    focusing = sparse.diags(power, 0, (nx, nx))
-    focusing = sparse.bmat([[focusing, None], [None, focusing]])
-    operator = (
-        -1/2 * laplacian +
-        potential -
-        focusing +
-        delta +
-        loss)
-    return operator.dot(state) - pump
+    shift = args.delta - (real**2 + imag**2)
+    result = scipy.empty(2*nx)
+    hamiltonian.apply(real, shift, out=result[:nx])
+    hamiltonian.apply(imag, shift, out=result[nx:])
+    result[:nx] += args.loss * imag
+    result[nx:] -= args.loss * real
+    result[:nx] -= args.pump
+    return result
 
 initial = scipy.zeros(2*nx)
 if args.input:
@@ -127,6 +124,7 @@ workspace["x"] = x
 workspace["potential"] = u
 workspace["n"] = args.n
 workspace["delta"] = args.delta
+workspace["order"] = args.order
 workspace["solution"] = solution[:nx] + 1j * solution[nx:]
 workspace["pump"] = args.pump
 workspace["loss"] = args.loss